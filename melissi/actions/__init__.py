@@ -15,6 +15,8 @@ import twisted.internet.defer as defer
 
 # melissi modules
 import melissi.dbschema as db
+import melissi.delta
+import melissi.jsonstream
 import melissi.util
 
 class NotImplementedError(Exception):
@@ -59,32 +61,152 @@ class DropItem(Exception):
 
     pass
 
+def cell_key(id):
+    """ Key of the Queue dependency graph for the cell with `id` """
+    return ('cell', id)
+
+def path_key(path):
+    """ Key of the Queue dependency graph for the directory `path` """
+    return ('path', os.path.normpath(path))
+
 class WaitItem(Exception):
     """
     Raise when an actions should wait for another action.
 
     When an actions depends on another action, raise a WaitItem with
-    parameters the unique_id of the action to wait for. Your action
-    will be added to the Queue.waiting_list and will be put in the
-    normal queue again, when the action it wait for successfully
-    finishes execution.
+    `id`, the id of a cell, or `path`, the full path of a directory,
+    which the other action provides, see WorkerAction.provides. Your
+    action will be added to the Queue.waiting_list and will be put in
+    the normal queue again, when an action providing it successfully
+    finishes execution, or when no queued action provides it anymore.
 
     For example when a DropletUpdate want to write into a Directory
     not yet created from a CellUpdate, raise a WaitItem exception with
-    `id`, the id of the Cell.
+    `id`, the id of the Cell. When a ModifyFile finds no record of
+    its directory raise a WaitItem with `path`, the directory, which
+    a CreateDir provides.
 
     """
-    def __init__(self, id):
+    def __init__(self, id=None, path=None):
         super(WaitItem, self).__init__()
         self.id = id
+        self.path = path
+
+    @property
+    def key(self):
+        if self.path is not None:
+            return path_key(self.path)
+        return cell_key(self.id)
 
 class WorkerAction(object):
+    """
+    Base class of all actions executed by the Worker.
+
+    Many actions may run at the same time. To stay safe an action
+    should only change database records in the callback that runs
+    after the server replied, because a failing action rolls back the
+    whole store.
+
+    """
+    # when True the Worker never runs this action concurrently with
+    # any other action
+    exclusive = False
+
+    # when True the action sends a single request through
+    # RestClient.batch, and the Worker may run more of them at once
+    batchable = False
+
+    # when True the action is stored in the queue table while queued,
+    # waiting or retrying, so that it survives a restart. Its
+    # constructor arguments must be JSON serializable, see
+    # Queue.sync_journal
+    persistent = True
+
+    # the lane of the Queue the action is placed in
+    lane = 'metadata'
+
+    def __new__(cls, hub, *args, **kwargs):
+        self = super(WorkerAction, cls).__new__(cls)
+
+        # the arguments to create the action again, see Queue.restore
+        self.arguments = (args, kwargs)
+        return self
+
     def __init__(self, hub):
         self._hub = hub
         self._dms = hub.database_manager.store
 
         self._action_taken = False
 
+        # times the action raised RetryLater, see Worker
+        self.attempts = 0
+
+        # the row of the queue table and what we wait for, see Queue
+        self.journal_id = None
+        self.waiting_id = None
+
+    @property
+    def queue_key(self):
+        """
+        Actions with equal keys are duplicates of each other, see
+        Queue.put
+        """
+        return (self.__class__,
+                self.unique_id,
+                getattr(self, 'watchpath', None))
+
+    def coalesce(self, other):
+        """
+        Merge `other`, a newer action with the same queue_key, into
+        this queued action. Return False if both actions must be
+        executed.
+
+        Local actions read the filesystem and the database when they
+        execute, so by default the newer action is redundant.
+        """
+        return True
+
+    @property
+    def provides(self):
+        """
+        Return the keys, see cell_key and path_key, of the things
+        this action creates. Actions waiting for them, see WaitItem,
+        are released when it succeeds
+        """
+        return ()
+
+    @property
+    def size(self):
+        """ Bytes the action transfers, if known, see Queue.put """
+        return 0
+
+    @property
+    def locks(self):
+        """
+        Return a tuple of two sets (exclusive, shared) with the
+        resources this action touches. Resources are full paths or
+        ('cell', id) / ('droplet', id) tuples. The Worker does not run
+        two actions concurrently if one of them holds exclusively a
+        resource the other holds in any way.
+        """
+        return (set(), set())
+
+    def _path_locks(self, *paths):
+        # lock paths exclusively and all their parents shared, so
+        # that parents are not moved or deleted while we work
+        exclusive = set()
+        shared = set()
+        for path in paths:
+            path = os.path.normpath(path)
+            exclusive.add(path)
+
+            parent = os.path.dirname(path)
+            while parent != path:
+                shared.add(parent)
+                path, parent = parent, os.path.dirname(parent)
+
+        return (exclusive, shared)
+
     @property
     def action_name(self):
         if self.unique_id:
@@ -120,7 +242,18 @@ class WorkerAction(object):
         if self._action_taken:
             self._send_notification()
 
+    def _fetch_file_by_path(self, filename, watchpath=None):
+        # `filename` relative to `watchpath`, by default ours
+        return self._hub.database_manager.get_file_by_path(
+            watchpath or self.watchpath, filename) or False
+
+    def _fetch_file_by_id(self, id, directory):
+        return self._hub.database_manager.get_file_by_id(id, directory) or False
+
     def _fetch_file_record(self, **kwargs):
+        # generic, slow lookup, prefer _fetch_file_by_path and
+        # _fetch_file_by_id
+        #
         # keys format:
         # File__filename is converted to db.File.filename
         query = self._dms.find(db.File)
@@ -135,15 +268,26 @@ class WorkerAction(object):
 
         return query.one() or False
 
+    def _signature_builder(self, size):
+        """
+        Return a delta.SignatureBuilder for a file of `size` bytes, or
+        None if delta sync is disabled
+        """
+        if not self._hub.config_manager.get_delta_sync():
+            return None
+
+        return melissi.delta.SignatureBuilder(melissi.delta.block_size_for(size))
+
     def _wakeup_waiting(self, result):
-        self._hub.queue.wake_up(self.unique_id)
+        for key in self.provides:
+            self._hub.queue.wake_up(key)
 
     def _execute(self):
         raise NotImplementedError("WorkerAction not implemented error")
 
     def __call__(self):
-        # TODO maybe we should handle DropItems here since we need to
-        # call _wakeup_waiting as well
+        # dropped actions release their waiting actions in
+        # Queue.done
 
         d = defer.maybeDeferred(self._execute)
         d.addCallback(self._notify)
@@ -40,6 +40,8 @@ class DeleteObject(WorkerAction):
     folder
     """
 
+    batchable = True
+
     def __init__(self, hub, filename, watchpath):
         super(DeleteObject, self).__init__(hub)
 
@@ -54,12 +56,14 @@ class DeleteObject(WorkerAction):
         else:
             return self.filename
 
+    @property
+    def locks(self):
+        return self._path_locks(pathjoin(self.watchpath, self.filename))
+
     def exists(self):
         # return record if item exists in the database
         # else return False
-        return self._fetch_file_record(File__filename=self.filename,
-                                       WatchPath__path=self.watchpath
-                                       )
+        return self._fetch_file_by_path(self.filename)
 
     def _execute(self):
         self._record = self.exists()
@@ -82,11 +86,13 @@ class DeleteObject(WorkerAction):
                                                self.watchpath)
                                     )
         else:
-            # delete from database
-            self._delete_from_db()
+            # notify server and then delete from database
+            d = self._post_to_server()
+            d.addCallback(self._success)
+            return d
 
-            # notify server
-            return self._post_to_server()
+    def _success(self, result):
+        self._delete_from_db()
 
     def _failure(self, result):
         log.error("Failure in delete %s" % result)
@@ -99,13 +105,8 @@ class DeleteDir(DeleteObject):
 
     def _delete_from_db(self):
         # delete all children
-        for entry in self._dms.find(db.File,
-                                    db.File.filename.like(u'%s/%%' % self.filename),
-                                    db.File.directory == True,
-                                    db.WatchPath.path == self.watchpath,
-                                    db.WatchPath.id == db.File.watchpath_id
-                                    ):
-            self._dms.remove(entry)
+        self._hub.database_manager.delete_subtree(self._record.watchpath_id,
+                                                  self._record.filename)
 
         # delete self
         self._dms.remove(self._record)
@@ -122,7 +123,7 @@ class DeleteDir(DeleteObject):
     def _post_to_server(self):
         uri = '%s/api/cell/%s/' % (self._hub.config_manager.get_server(),
                                self._record.id)
-        d = self._hub.rest_client.delete(str(uri))
+        d = self._hub.rest_client.batch('DELETE', str(uri))
         d.addErrback(self._failure)
 
         return d
@@ -147,7 +148,7 @@ class DeleteFile(DeleteObject):
     def _post_to_server(self):
         uri = '%s/api/droplet/%s/' % (self._hub.config_manager.get_server(),
                                   self._record.id)
-        d = self._hub.rest_client.delete(str(uri))
+        d = self._hub.rest_client.batch('DELETE', str(uri))
         d.addErrback(self._failure)
 
         return d
@@ -164,6 +165,10 @@ class DeleteObjectId(WorkerAction):
     def unique_id(self):
         return self._objectid
 
+    @property
+    def locks(self):
+        return (set([(self._kind, self._objectid)]), set())
+
     def _execute(self):
         self._record = self.exists()
         if not self._record:
@@ -179,23 +184,19 @@ class DeleteObjectId(WorkerAction):
         raise RetryLater
 
 class DeleteObjectIdCell(DeleteObjectId):
+    _kind = 'cell'
+
     def _delete_from_db(self):
         # delete all children
-        for entry in self._dms.find(db.File,
-                                    db.File.filename.like(u'%s/%%' % self._record.filename),
-                                    db.WatchPath.id == self._record.watchpath_id,
-                                    db.WatchPath.id == db.File.watchpath_id
-                                    ):
-            self._dms.remove(entry)
+        self._hub.database_manager.delete_subtree(self._record.watchpath_id,
+                                                  self._record.filename)
 
         # delete self
         self._dms.remove(self._record)
 
 
     def exists(self):
-        return self._fetch_file_record(File__id=self._objectid,
-                                       File__directory=True
-                                       )
+        return self._fetch_file_by_id(self._objectid, True)
 
     def _post_to_server(self):
         uri = '%s/api/cell/%s/' % (self._hub.config_manager.get_server(),
@@ -207,14 +208,14 @@ class DeleteObjectIdCell(DeleteObjectId):
 
 
 class DeleteObjectIdDroplet(DeleteObjectId):
+    _kind = 'droplet'
+
     def _delete_from_db(self):
         # delete self
         self._dms.remove(self._record)
 
     def exists(self):
-        return self._fetch_file_record(File__id=self._objectid,
-                                       File__directory=False
-                                       )
+        return self._fetch_file_by_id(self._objectid, False)
 
     def _post_to_server(self):
         uri = '%s/api/droplet/%s/' % (self._hub.config_manager.get_server(),
@@ -5,13 +5,15 @@
 from melissi.actions import *
 
 class RescanDirectories(WorkerAction):
+    lane = 'maintenance'
+
     def __init__(self, hub, directories=None):
         super(RescanDirectories, self).__init__(hub)
         self._directories = directories
 
     @property
     def unique_id(self):
-        return ' '.join(self._directories) or "all"
+        return ' '.join(self._directories or []) or "all"
 
     def _execute(self):
         self._hub.notify_manager.rescan_directories(self._directories)
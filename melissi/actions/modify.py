@@ -16,6 +16,7 @@ class ModifyFile(WorkerAction):
 
         self.filename = filename
         self.watchpath = watchpath
+        self._size = None
 
     @property
     def unique_id(self):
@@ -25,10 +26,28 @@ class ModifyFile(WorkerAction):
     def fullpath(self):
         return pathjoin(self.watchpath, self.filename)
 
+    @property
+    def locks(self):
+        return self._path_locks(self.fullpath)
+
+    @property
+    def size(self):
+        if self._size is None:
+            try:
+                self._size = os.path.getsize(self.fullpath)
+            except OSError:
+                self._size = 0
+
+        return self._size
+
+    @property
+    def lane(self):
+        if self.size >= self._hub.config_manager.get_large_file_size():
+            return 'large'
+        return 'small'
+
     def _record_get_or_create(self):
-        record = self._fetch_file_record(File__filename=self.filename,
-                                         WatchPath__path=self.watchpath
-                                         )
+        record = self._fetch_file_by_path(self.filename)
 
         if not record:
             record = db.File()
@@ -38,21 +57,16 @@ class ModifyFile(WorkerAction):
             record.directory = False
             record.revision = 1
             record.parent_id = self._parent.id
-            self._dms.add(record)
 
         return record
 
     def _get_parent(self):
-        parent = self._fetch_file_record(File__filename=os.path.dirname(self.filename),
-                                         WatchPath__path=self.watchpath
-                                         )
+        parent = self._fetch_file_by_path(os.path.dirname(self.filename))
 
         if not parent:
-            if os.path.exists(os.path.dirname(pathjoin(self.watchpath, self.filename))):
-                # sadly we cannot use WaitItem because we don't know
-                # cellid yet
-                raise RetryLater("Parent does not exist in db [%s]" % \
-                                 os.path.dirname(self.filename))
+            if os.path.exists(os.path.dirname(self.fullpath)):
+                # wait for the CreateDir of the parent
+                raise WaitItem(path=os.path.dirname(self.fullpath))
             else:
                 raise DropItem("Parent does not exist in db or fs [%s]" % \
                                os.path.dirname(self.filename))
@@ -62,93 +76,198 @@ class ModifyFile(WorkerAction):
     def _execute(self):
         self._parent = self._get_parent()
         self._record = self._record_get_or_create()
-        self._hash = melissi.util.get_hash(filename=self.fullpath)
 
-        if self._hash == self._record.hash:
+        try:
+            self._stat = melissi.util.get_stat(self.fullpath)
+        except OSError, error_message:
+            raise DropItem("Cannot stat file [%s]" % error_message)
+
+        if self._record.hash and self._stat == self._record.stat:
             log.debug("File not modified, ignoring")
             raise DropItem("File not modified, ignoring")
 
-        self._record.hash = self._hash
+        if self._record.hash and self._record.size in (None, self._stat[0]):
+            # maybe only touched, or we don't know the stat yet. We
+            # must know if the file changed before uploading
+            d = melissi.util.defer_hash(filename=self.fullpath)
+            d.addCallback(self._check_hash)
+            return d
+
+        # new file or size changed, the file is modified for
+        # sure. Hash while uploading so that the file is read only
+        # once
+        self._hash = None
+        return self._upload()
+
+    def _check_hash(self, file_hash):
+        self._hash = file_hash
+
+        if self._hash == self._record.hash:
+            # remember the new stat, to avoid hashing next time
+            log.debug("File not modified, updating stat")
+            self._record.stat = self._stat
+            return
+
+        return self._upload()
+
+    def _upload(self):
+        try:
+            self._file_handler = open(self.fullpath, 'rb')
+        except (OSError, IOError) as error_message:
+            raise RetryLater("Error opening file [%s]" % error_message)
+
+        # build the signature of the new content while reading it
+        self._signature = self._signature_builder(self._stat[0])
+
+        if not self._hash or self._signature:
+            self._file_handler = melissi.util.HashingFile(self._file_handler,
+                                                          self._signature)
 
         if self._record.id:
-            # patch = True
-            # self._file_handler = util.get_delta(self._record.signature,
-            #                                     self.fullpath)
-            # return self._put_revision()
-            try:
-                self._file_handler = open(self.fullpath)
-            except (OSError, IOError) as error_message:
-                raise RetryLater("Error opening file")
+            if self._signature and self._record.signature:
+                # send only the differences
+                d = melissi.util.defer_to_pool(self._make_delta,
+                                               self._record.signature)
+                d.addCallback(self._post_patch)
+                return d
+
             return self._post_revision()
 
         else:
-            patch = False
+            return self._post_droplet()
+
+    def _make_delta(self, signature):
+        # runs in the hash pool, so don't touch the store
+        delta_file = tempfile.TemporaryFile(prefix='melissi-',
+                                            suffix='.delta')
+        try:
+            length = melissi.delta.delta(signature, self._file_handler,
+                                         delta_file,
+                                         melissi.delta.MAX_ROLLED)
+        except melissi.delta.TooDifferent as error_message:
+            log.debug("No delta, %s" % error_message)
+            delta_file.close()
+            # read the rest for the hash and the signature
+            while self._file_handler.read(melissi.delta.READ_SIZE):
+                pass
+            return None, None
+
+        delta_file.seek(0)
+
+        return delta_file, length
+
+    def _post_patch(self, result):
+        delta_file, length = result
+
+        # the whole file was read through the HashingFile
+        self._file_handler.close()
+        self._hash = self._hash or self._file_handler.hexdigest()
+
+        if length is None or length >= self._stat[0]:
+            # nothing to gain, send the whole file
+            if delta_file:
+                delta_file.close()
             try:
-                self._file_handler = open(self.fullpath)
+                self._file_handler = open(self.fullpath, 'rb')
             except (OSError, IOError) as error_message:
-                raise RetryLater("Error opening file")
+                raise RetryLater("Error opening file [%s]" % error_message)
 
-            return self._post_droplet()
+            return self._post_revision()
+
+        log.debug("Sending delta of %s bytes instead of %s" % (length,
+                                                                self._stat[0]))
+        self._file_handler = delta_file
+        return self._post_revision(patch=True)
+
+    def _post(self, uri, data):
+        if self._hash:
+            data['content_sha256'] = self._hash
+            digest_field = None
+        else:
+            # the producer sends the hash after the content
+            digest_field = 'content_sha256'
+
+        d = self._hub.rest_client.post(str(uri), data=data,
+                                       file_handle=self._file_handler,
+                                       digest_field=digest_field)
+        d.addCallback(self._success_callback)
+        d.addErrback(self._failure_callback)
+        return d
 
     def _post_droplet(self):
         uri = '%s/api/droplet/' % self._hub.config_manager.get_server()
         data = { 'name': os.path.basename(self.filename),
                  'cell': self._parent.id,
-                 'content_sha256': self._record.hash,
                  }
-        d = self._hub.rest_client.post(str(uri), data=data, file_handle=self._file_handler)
-        d.addCallback(self._success_callback)
-        d.addErrback(self._failure_callback)
-        return d
+        return self._post(uri, data)
 
-    def _post_revision(self):
+    def _post_revision(self, patch=False):
         uri = '%s/api/droplet/%s/revision/' % (self._hub.config_manager.get_server(), self._record.id)
-        data = {'content_sha256': self._record.hash,
-                'number': self._record.revision + 1,
-                'patch': False
+        data = {'number': self._record.revision + 1,
+                'patch': patch
                 }
-        d = self._hub.rest_client.post(str(uri), data=data, file_handle=self._file_handler)
-        d.addCallback(self._success_callback)
-        d.addErrback(self._failure_callback)
-        return d
+        return self._post(uri, data)
 
     def _success_callback(self, result):
+        self._file_handler.close()
+
         result = json.load(result.content)
-        # self._record.signature = util.get_signature(self.fullpath)
-        self._record.signature = None
+        self._record.hash = self._hash or self._file_handler.hexdigest()
+        self._record.stat = self._stat
+        if self._signature:
+            self._record.signature = self._signature.signature()
+        else:
+            self._record.signature = None
         self._record.revision = result['reply']['revisions']
         self._record.modified = melissi.util.parse_datetime(result['reply']['updated'])
         self._record.id = result['reply']['id']
 
+        # new records are added only now, see WorkerAction
+        self._dms.add(self._record)
+
     def _failure_callback(self, error):
+        self._file_handler.close()
+
         log.debug("Failure in modify %s" % error)
         raise RetryLater("Failure in modify")
 
 class CreateDir(WorkerAction):
+    batchable = True
+    lane = 'priority'
+
     def __init__(self, hub, filename, watchpath):
         super(CreateDir, self).__init__(hub)
         self.filename = filename
         self.watchpath = watchpath
+        self._record = None
 
     @property
     def unique_id(self):
         return self.filename
 
+    @property
+    def locks(self):
+        return self._path_locks(pathjoin(self.watchpath, self.filename))
+
+    @property
+    def provides(self):
+        keys = [path_key(pathjoin(self.watchpath, self.filename))]
+        if self._record is not None and self._record.id is not None:
+            keys.append(cell_key(self._record.id))
+        return keys
+
     def _exists(self):
         # return record if item exists in the database
         # else return False
-        return self._fetch_file_record(File__filename=self.filename,
-                                       WatchPath__path=self.watchpath
-                                       )
+        return self._fetch_file_by_path(self.filename)
 
     def _get_parent(self):
-        parent = self._fetch_file_record(File__filename=os.path.dirname(self.filename),
-                                         WatchPath__path=self.watchpath
-                                         )
+        parent = self._fetch_file_by_path(os.path.dirname(self.filename))
         if not parent:
-            if os.path.exists(os.path.dirname(pathjoin(self.watchpath, self.filename))):
-                raise RetryLater("Parent does not exist in db [%s]" % \
-                                 os.path.dirname(self.filename))
+            directory = os.path.dirname(pathjoin(self.watchpath, self.filename))
+            if os.path.exists(directory):
+                # wait for the CreateDir of the parent
+                raise WaitItem(path=directory)
             else:
                 raise DropItem("Parent does not exists in db or fs [%s]" % \
                                os.path.dirname(self.filename))
@@ -184,7 +303,7 @@ class CreateDir(WorkerAction):
                 'number': self._record.revision + 1
                 }
 
-        d = self._hub.rest_client.post(str(uri), data=data)
+        d = self._hub.rest_client.batch('POST', str(uri), data)
         d.addCallback(self._success)
         d.addErrback(self._failure)
 
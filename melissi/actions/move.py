@@ -11,6 +11,8 @@ import melissi.util
 from melissi.actions import *
 
 class MoveObject(WorkerAction):
+    batchable = True
+
     def __init__(self, hub, filename, old_filename, watchpath):
         super(MoveObject, self).__init__(hub)
 
@@ -22,20 +24,25 @@ class MoveObject(WorkerAction):
     def unique_id(self):
         return pathjoin(self.watchpath, self.filename)
 
+    @property
+    def locks(self):
+        return self._path_locks(pathjoin(self.watchpath, self.filename),
+                                pathjoin(self.watchpath, self.old_filename))
+
+    def coalesce(self, other):
+        return self.old_filename == other.old_filename
+
     def _exists(self):
         # return record if item exists in the database
         # else return False
-        return self._fetch_file_record(File__filename=self.old_filename,
-                                       WatchPath__path=self.watchpath)
+        return self._fetch_file_by_path(self.old_filename)
 
     def _get_parent(self):
-        parent = self._fetch_file_record(File__filename=os.path.dirname(self.filename),
-                                         WatchPath__path=self.watchpath
-                                         )
+        parent = self._fetch_file_by_path(os.path.dirname(self.filename))
         if not parent:
-            # sadly we cannot use WaitItem because we don't know
-            # cellid yet
-            raise RetryLater
+            # wait for the CreateDir or MoveDir of the parent
+            raise WaitItem(path=os.path.dirname(pathjoin(self.watchpath,
+                                                         self.filename)))
         else:
             return parent
 
@@ -48,26 +55,22 @@ class MoveObject(WorkerAction):
     def _update_children(self):
         # update all subdirectories and files if this is directory
         # change subfiles / subdirectories in database
-        query = self._dms.find(db.File,
-                               db.File.filename.like(u'%s/%%' % self.old_filename),
-                               db.WatchPath.path == self._record.watchpath.path,
-                               db.WatchPath.id == db.File.watchpath_id
-                               )
-        for f in query:
-            f.filename = f.filename.replace(self.old_filename, self.filename, 1)
-            f.watchpath = self._parent.watchpath
+        self._hub.database_manager.rename_subtree(self._old_watchpath_id,
+                                                  self.old_filename,
+                                                  self._parent.watchpath_id,
+                                                  self._record.filename)
 
     def _execute(self):
         self._record = self._exists()
 
         if not self._record:
             raise DropItem("We already did the move")
+        self._old_watchpath_id = self._record.watchpath_id
 
         # check if we are overwriting another file or folder
         # if yes, we must first delete that
         # execute instantly, don't go to queue
-        self._replace_record =  self._fetch_file_record(File__filename=self.filename,
-                                                        WatchPath__path=self.watchpath)
+        self._replace_record =  self._fetch_file_by_path(self.filename)
         if self._replace_record:
             # delete ids
             if self._replace_record.directory:
@@ -97,9 +100,8 @@ class MoveFile(MoveObject):
     def __init__(self, hub, filename, old_filename, watchpath):
         super(MoveFile, self).__init__(hub, filename, old_filename, watchpath)
 
-    @property
-    def _action(self):
-        return self._hub.rest_client.post
+    def _action(self, uri, data):
+        return self._hub.rest_client.batch('POST', uri, data)
 
     def _get_data(self):
         return {'name'  : os.path.basename(self.filename),
@@ -128,12 +130,17 @@ class MoveFile(MoveObject):
         raise RetryLater
 
 class MoveDir(MoveObject):
+    lane = 'priority'
+
+    @property
+    def provides(self):
+        return [path_key(pathjoin(self.watchpath, self.filename))]
+
     def __init__(self, hub, filename, old_filename, watchpath):
         super(MoveDir, self).__init__(hub, filename, old_filename, watchpath)
 
-    @property
-    def _action(self):
-        return self._hub.rest_client.put
+    def _action(self, uri, data):
+        return self._hub.rest_client.batch('PUT', uri, data)
 
     def _get_data(self):
         return {'name'  : os.path.basename(self.filename),
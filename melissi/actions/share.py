@@ -22,6 +22,13 @@ class Share(WorkerAction):
     def unique_id(self):
         return self.filename
 
+    @property
+    def locks(self):
+        return self._path_locks(pathjoin(self.watchpath, self.filename))
+
+    def coalesce(self, other):
+        return self.mode == other.mode and self.user == other.user
+
     def _exists(self):
         # return record if item exists in the database else return
         # False
@@ -13,6 +13,20 @@ import melissi.util
 from melissi.actions import *
 
 class GetUpdates(WorkerAction):
+    """
+    Fetch the changes after our timestamp, in pages of
+    ConfigManager.get_update_page_size cells and droplets. The server
+    replies with a 'cursor' in the reply when there are more pages.
+    Replies are parsed incrementally, see jsonstream.iterparse.
+
+    The updates of every page are queued as it arrives, parents
+    first: cells by depth, then droplets, so that they don't wait for
+    each other, see _queue_updates. Updates whose cell comes in a
+    later page are retried until it is queued, see Worker
+    """
+    # RestClient.connect queues one on every start
+    persistent = False
+
     def __init__(self, hub, full=False):
         super(GetUpdates, self).__init__(hub)
         self.full = full
@@ -23,46 +37,116 @@ class GetUpdates(WorkerAction):
                                             self.timestamp
                                             )
 
-    def _add_to_queue(self, item, when=0):
-        reactor.callLater(when, self._hub.queue.put, item)
+    def coalesce(self, other):
+        # one GetUpdates is enough, but keep a full update if asked
+        self.full = self.full or other.full
+        return True
 
     def _execute(self):
         self.timestamp = 0 if self.full else self._hub.config_manager.get_timestamp()
 
-        d = self._hub.rest_client.get(self._uri)
+        # the timestamp of the first page, changes made while we
+        # fetch the rest are fetched again next time
+        self._timestamp = None
+        self._changes = False
+        self._cells = []
+        self._droplets = []
+
+        return self._get_page()
+
+    def _get_page(self, cursor=None):
+        arguments = {'limit': self._hub.config_manager.get_update_page_size()}
+        if cursor:
+            arguments['cursor'] = cursor
+
+        d = self._hub.rest_client.get(self._uri + melissi.util.urlencode(arguments))
         d.addCallback(self._success)
         d.addErrback(self._failure)
 
         return d
 
     def _success(self, result):
-        result = json.load(result.content)
-
-        if 'error' in result.keys():
-            raise Exception(result['error'])
-
-        for cell in result['reply']['cells']:
-            self._add_to_queue(
-                CellUpdate(hub=self._hub, **cell)
-                )
-
-        for droplet in result['reply']['droplets']:
-            self._add_to_queue(
-                DropletUpdate(hub=self._hub, **droplet)
-                )
+        cursor = None
+        for name, value in melissi.jsonstream.iterparse(result.content,
+                                                        ('cells', 'droplets'),
+                                                        ('error',)):
+            if name == 'cells':
+                self._cells.append(CellUpdate(hub=self._hub, **value))
+            elif name == 'droplets':
+                self._droplets.append(DropletUpdate(hub=self._hub, **value))
+            elif name == 'error':
+                raise Exception(value)
+            elif name == 'timestamp' and self._timestamp is None:
+                self._timestamp = value
+            elif name == 'cursor':
+                cursor = value
+
+        self._changes = self._changes or bool(self._cells or self._droplets)
+        self._queue_updates()
+
+        if cursor:
+            return self._get_page(cursor)
 
         # update timestamp
-        self._hub.config_manager.set_timestamp(result['timestamp'])
-
-        # place a GetUpdates in queue
-        self._add_to_queue(GetUpdates(hub=self._hub),
-                           when=self._hub.config_manager.get_update_interval()
-                           )
+        if self._timestamp is not None:
+            self._hub.config_manager.set_timestamp(self._timestamp)
+
+        # wait for the server to tell us about changes, or place a
+        # GetUpdates in queue
+        if not self._hub.rest_client.wait_for_updates():
+            self._hub.rest_client.poll_updates(self._changes)
+
+    def _queue_updates(self):
+        # the depth of a cell in this page, cells whose parent is
+        # not in the page have depth 0
+        cells = dict((cell.id, cell) for cell in self._cells)
+        depths = {}
+        for cell in self._cells:
+            # walk up to a cell we know the depth of, or to the top.
+            # Cells are marked before their depth is known, to stop
+            # at cycles
+            path = []
+            while cell.id not in depths:
+                depths[cell.id] = 0
+                path.append(cell)
+                if cell.parent not in cells:
+                    break
+                cell = cells[cell.parent]
+
+            for cell in reversed(path):
+                if cell.parent in cells:
+                    depths[cell.id] = depths[cell.parent] + 1
+
+        # bucket sort, keeping the server order within a depth
+        levels = {}
+        for cell in self._cells:
+            levels.setdefault(depths[cell.id], []).append(cell)
+
+        for depth in sorted(levels):
+            for cell in levels[depth]:
+                self._hub.queue.put(cell)
+
+        for droplet in self._droplets:
+            self._hub.queue.put(droplet)
+
+        self._cells = []
+        self._droplets = []
 
     def _failure(self, result):
         log.debug("Get updates failure %s" % result)
 
+        # don't stop updating until we connect again
+        self._hub.rest_client.poll_updates()
+
 class CellUpdate(WorkerAction):
+    # cell updates move and delete whole directory trees, run them
+    # alone
+    exclusive = True
+
+    # in the same lane as droplets, so that they keep the order of
+    # GetUpdates._queue_updates
+    lane = 'updates'
+
     def __init__(self, hub, id, name, pid, revisions, owner, created, updated, deleted):
         super(CellUpdate, self).__init__(hub)
 
@@ -81,10 +165,18 @@ class CellUpdate(WorkerAction):
     def unique_id(self):
         return self.id
 
+    @property
+    def provides(self):
+        return [cell_key(self.id)]
+
+    def coalesce(self, other):
+        # updates carry server state, execute all in order
+        return False
+
     def exists(self):
         # return record if item exists in the database
         # else return False
-        return self._fetch_file_record(File__id=self.id, File__directory=True)
+        return self._fetch_file_by_id(self.id, True)
 
     def is_root(self):
         if not self.parent:
@@ -95,9 +187,7 @@ class CellUpdate(WorkerAction):
     def parent_exists(self):
         # return True if parent exists
         if not self.is_root():
-            return self._fetch_file_record(File__id=self.parent,
-                                           File__directory=True
-                                           )
+            return self._fetch_file_by_id(self.parent, True)
 
         else:
             return False
@@ -224,13 +314,8 @@ class CellUpdate(WorkerAction):
                 shutil.rmtree(self.fullpath, ignore_errors=True)
 
                 # remove children and self from database
-                for child in self._dms.find(db.File,
-                                            db.File.filename.like(u'%s/%%' % self._record.filename),
-                                            db.File.directory == True,
-                                            db.WatchPath.path == self._record.watchpath.path,
-                                            db.WatchPath.id == db.File.watchpath_id
-                                            ):
-                    self._dms.remove(child)
+                self._hub.database_manager.delete_subtree(self._record.watchpath_id,
+                                                          self._record.filename)
 
 
             # file was updated
@@ -242,6 +327,7 @@ class CellUpdate(WorkerAction):
                     parent = self.parent_exists()
                     oldfilename = self._record.filename
                     oldwatchpath = self._record.watchpath.path
+                    oldwatchpath_id = self._record.watchpath_id
 
                     self._record.filename = pathjoin(parent.filename, self.name)
                     self._record.watchpath = parent.watchpath
@@ -253,13 +339,10 @@ class CellUpdate(WorkerAction):
                     shutil.move(oldpath, self.fullpath)
 
                     # change subfiles / subdirectories in database
-                    for child in self._dms.find(db.File,
-                                                db.File.filename.like(u'%s/%%' % oldfilename),
-                                                db.WatchPath.path == oldwatchpath,
-                                                db.WatchPath.id == db.File.watchpath_id
-                                                ):
-                        child.filename = child.filename.replace(oldfilename, self._record.filename, 1)
-                        child.watchpath = self._record.watchpath
+                    self._hub.database_manager.rename_subtree(oldwatchpath_id,
+                                                              oldfilename,
+                                                              parent.watchpath_id,
+                                                              self._record.filename)
 
                 else:
                     # nothing happened
@@ -275,6 +358,8 @@ class CellUpdate(WorkerAction):
         self._action_taken = True
 
 class DropletUpdate(WorkerAction):
+    lane = 'updates'
+
     def __init__(self, hub, id, name, cell, owner, created, updated,
                  content_sha256, patch_sha256, deleted, revisions):
         super(DropletUpdate, self).__init__(hub)
@@ -291,21 +376,52 @@ class DropletUpdate(WorkerAction):
         self.revisions = revisions
 
         self._new = True
+        self._watchpath = None
+        self._signature = None
+
+        # the cell we move to, see _move
+        self._parent = None
 
     @property
     def unique_id(self):
         return self.id
 
+    def coalesce(self, other):
+        # updates carry server state, execute all in order
+        return False
+
+    @property
+    def locks(self):
+        exclusive = set([('droplet', self.id)])
+        shared = set([('cell', self.cell['id'])])
+
+        cell = self.cell_exists()
+        if cell:
+            path_exclusive, path_shared = self._path_locks(
+                pathjoin(cell.watchpath.path, cell.filename, self.name)
+                )
+            exclusive |= path_exclusive
+            shared |= path_shared
+
+        # the file may move away from where we know it
+        record = self.exists()
+        if record:
+            path_exclusive, path_shared = self._path_locks(
+                pathjoin(record.watchpath.path, record.filename)
+                )
+            exclusive |= path_exclusive
+            shared |= path_shared
+
+        return (exclusive, shared)
+
     def exists(self):
         # return record if item exists in the database
         # else return False
-        return self._fetch_file_record(File__id=self.id, File__directory=False)
+        return self._fetch_file_by_id(self.id, False)
 
     def cell_exists(self):
         # return True if parent exists
-        return self._fetch_file_record(File__id=self.cell['id'],
-                                       File__directory=True,
-                                       )
+        return self._fetch_file_by_id(self.cell['id'], True)
 
     def _create_record(self):
         record = db.File()
@@ -317,13 +433,13 @@ class DropletUpdate(WorkerAction):
         record.modified = self.updated
 
         cell = self.cell_exists()
-        record.watchpath = cell.watchpath
+        record.watchpath_id = cell.watchpath_id
         record.parent_id = cell.id
         record.filename = pathjoin(cell.filename, self.name)
+        self._watchpath = cell.watchpath
 
-        # add to store
-        self._dms.add(record)
-
+        # the record is added to the store only after we have the
+        # file, see WorkerAction
         return record
 
     def _touch_file_datetime(self):
@@ -386,7 +502,10 @@ class DropletUpdate(WorkerAction):
     @property
     def fullpath(self):
         if self._record:
-            return pathjoin(self._record.watchpath.path,
+            # new records are not in the store yet and have no
+            # watchpath reference
+            watchpath = self._record.watchpath or self._watchpath
+            return pathjoin(watchpath.path,
                             self._record.filename)
         return False
 
@@ -396,8 +515,11 @@ class DropletUpdate(WorkerAction):
         os.chmod(self.fullpath, current_mode|256|128)
 
     def _generate_signature(self):
-        # return util.get_signature(self.fullpath)
-        return ''
+        # the signature is built while hashing, see
+        # _signature_builder
+        if self._signature:
+            return self._signature.signature()
+        return None
 
     def _execute(self):
         # if we don't know the file:
@@ -416,32 +538,16 @@ class DropletUpdate(WorkerAction):
             cell = self.cell_exists()
 
             # check if for some reason we already have the file
-            if os.path.exists(self.fullpath) and \
-                   melissi.util.get_hash(self.fullpath) == self._record.hash:
-
-                # ensure that we can read/write it
-                self.fix_permissions()
-
-                # generate signarute
-                self._record.signature = self._generate_signature()
-
-            else:
-                # we need to fetch the file
-                # return deferred
+            if os.path.exists(self.fullpath):
+                self._signature = self._signature_builder(os.path.getsize(self.fullpath))
+                d = melissi.util.defer_hash(filename=self.fullpath,
+                                            signature=self._signature)
+                d.addCallback(self._check_local_file)
+                return d
 
-                # if path exists, and hash is not the same, then this
-                # is a conflict
-                if os.path.exists(self.fullpath):
-                    log.debug("Conflict on file [%s]" % self.unique_id)
-
-                    resource = self.revisions[-1]['resource']
-                    if resource['user'] == self._hub.config_manager.get_username():
-                        msg = "your copy on '%s'" % resource['name']
-                    else:
-                        msg = "%s's copy" % resource['user']
-                    self._record.filename = melissi.util.append_to_filename(self._record.filename, msg)
-
-                return self._get_file()
+            # we need to fetch the file
+            # return deferred
+            return self._get_file()
 
         # we know the file
         else:
@@ -469,35 +575,67 @@ class DropletUpdate(WorkerAction):
                 self._action_taken = True
                 return
 
-            parent = self._get_parent()
-            if parent.id != self._record.parent_id:
-                oldfilename = self._record.filename
-                oldwatchpath = self._record.watchpath.path
-
-                self._record.filename = pathjoin(parent.filename, self.name)
-                self._record.watchpath = parent.watchpath
-                self._record.parent = parent
-
-                oldpath = pathjoin(oldwatchpath, oldfilename)
-
-                print "hey"
-                # move file
-                shutil.move(oldpath, self.fullpath)
+            # the file moves with the new content, if any
+            self._parent = self._get_parent()
 
             # check if file content changed
             # TODO be aware of race conditions here
             if self.content_sha256 != self._record.hash and \
                self.revisions > self._record.revision:
                 # yeah there is some new content, let's fetch this
-                # return self._get_patch()
+                if self._can_patch():
+                    return self._get_patch()
                 return self._get_file()
 
+            if self._parent.id != self._record.parent_id:
+                self._move()
+                self._action_taken = True
+                return
+
             raise DropItem("Do nothing")
 
+    def _move(self):
+        # the record and the file move together, once nothing can fail
+        # anymore, so that a rollback does not part them
+        if self._parent is None or self._parent.id == self._record.parent_id:
+            return
+
+        oldpath = self.fullpath
+        self._record.filename = pathjoin(self._parent.filename, self.name)
+        self._record.watchpath = self._parent.watchpath
+        self._record.parent = self._parent
+
+        shutil.move(oldpath, self.fullpath)
+
+    def _check_local_file(self, local_hash):
+        if local_hash == self._record.hash:
+            # ensure that we can read/write it
+            self.fix_permissions()
+
+            # generate signarute
+            self._record.signature = self._generate_signature()
+            self._record.stat = melissi.util.get_stat(self.fullpath)
+
+            # add to store
+            self._dms.add(self._record)
+
+        else:
+            # path exists, and hash is not the same, then this is a
+            # conflict
+            log.debug("Conflict on file [%s]" % self.unique_id)
+
+            resource = self.revisions[-1]['resource']
+            if resource['user'] == self._hub.config_manager.get_username():
+                msg = "your copy on '%s'" % resource['name']
+            else:
+                msg = "%s's copy" % resource['user']
+            self._record.filename = melissi.util.append_to_filename(self._record.filename, msg)
+
+            # we need to fetch the file
+            return self._get_file()
+
     def _get_parent(self):
-        parent = self._fetch_file_record(File__id=self.cell['id'],
-                                         File__directory=True,
-                                         )
+        parent = self._fetch_file_by_id(self.cell['id'], True)
 
         if not parent:
             raise WaitItem(self.cell['id'])
@@ -508,14 +646,67 @@ class DropletUpdate(WorkerAction):
         uri = '%(server)s/api/droplet/%(droplet_id)s/revision/latest/content/' %\
               {'server': self._hub.config_manager.get_server(),
                'droplet_id': self.id}
-        d = self._hub.rest_client.get(str(uri))
+        d = self._hub.rest_client.get(str(uri),
+                                      destination=os.path.dirname(self.fullpath),
+                                      signature=self._signature_builder)
         d.addCallback(self._get_file_success)
         d.addErrback(self._failure)
         return d
 
+    def _can_patch(self):
+        # a patch applies only to the revision we know, so the local
+        # file must not have changed since
+        if not (self._hub.config_manager.get_delta_sync() and \
+                self._record.signature):
+            return False
+
+        try:
+            return melissi.util.get_stat(self.fullpath) == self._record.stat
+        except OSError:
+            return False
+
     def _get_patch_success(self, result):
-        # try patching
-        melissi.util.patch_file(result, self.fullpath, self.content_sha256)
+        d = melissi.util.defer_to_pool(self._apply_patch,
+                                       result.content,
+                                       self.fullpath)
+        d.addCallback(self._patched)
+        d.addErrback(self._patch_failure)
+        return d
+
+    def _apply_patch(self, delta_file, fullpath):
+        # runs in the hash pool, so don't touch the store. Write the
+        # new file next to the old one and verify it
+        self._signature = self._signature_builder(os.path.getsize(fullpath))
+        tmp_file = tempfile.NamedTemporaryFile(dir=os.path.dirname(fullpath),
+                                               prefix=melissi.util.TEMP_PREFIX,
+                                               suffix='.tmp',
+                                               delete=False)
+        try:
+            out = melissi.util.HashingFile(tmp_file, self._signature)
+            with open(fullpath, 'rb') as old:
+                melissi.delta.patch(delta_file, old, out)
+            out.close()
+
+            if out.hexdigest() != self.content_sha256:
+                raise ValueError("Hashes don't match!")
+
+        except:
+            os.unlink(tmp_file.name)
+            raise
+
+        return tmp_file.name
+
+    def _patched(self, tmp_filename):
+        self._move()
+
+        # replace the file, keeping its permissions
+        shutil.copymode(self.fullpath, tmp_filename)
+        os.rename(tmp_filename, self.fullpath)
+        self.fix_permissions()
+
+        # update time
+        self._touch_file_datetime()
+        self._record.stat = melissi.util.get_stat(self.fullpath)
 
         # ok same changes in db
         self._record.signature = self._generate_signature()
@@ -526,44 +717,66 @@ class DropletUpdate(WorkerAction):
         # notify user
         self._action_taken = True
 
+    def _patch_failure(self, error):
+        log.debug("Patching failed, fetching the whole file: %s" % error)
+
+        # the server may have no patch, remove its error reply
+        response = getattr(error, 'value', None)
+        if hasattr(response, 'discard'):
+            response.discard()
+
+        return self._get_file()
+
     def _get_patch(self):
         uri = '%(server)s/api/droplet/%(droplet_id)s/revision/latest/patch/' %\
               {'server': self._hub.config_manager.get_server(),
                'droplet_id': self.id}
         d = self._hub.rest_client.get(str(uri))
-        d.addCallback(self._get_patch_success)
-        d.addErrback(self._failure)
+        d.addCallbacks(self._get_patch_success, self._patch_failure)
 
         return d
 
     def _get_file_success(self, result):
+        # the content was hashed while received, into a temporary
+        # file next to ours, see receiver.APIResponse
+        result.content.close()
+        self._signature = result.signature
+
         # ok same changes in db
         self._record.hash = self.content_sha256
         # check the hash
-        if not melissi.util.get_hash(f=result.content) == self._record.hash:
+        if not result.hexdigest() == self._record.hash:
             # oups
             log.debug("Hashes don't match!")
+            result.discard()
             raise ValueError("Hashes don't match!")
 
-        # set write permissions first
+        self._move()
+
+        # keep the permissions of the file we replace
         # Warning: we are actually chaning permissions on
         # user files, so we must warn them on README
-        # set user read+write
         if os.path.exists(self.fullpath):
-            current_mode = os.stat(self.fullpath).st_mode
-            os.chmod(self.fullpath, current_mode|256|128)
+            shutil.copymode(self.fullpath, result.content.name)
+
+        # replace file
+        os.rename(result.content.name, self.fullpath)
 
-        # copy file
-        shutil.copyfile(result.content.name, self.fullpath)
+        # set user read+write
+        self.fix_permissions()
 
         # update time
         self._touch_file_datetime()
+        self._record.stat = melissi.util.get_stat(self.fullpath)
 
         # update signature, revision and time
         self._record.signature = self._generate_signature()
         self._record.revision = self.revisions
         self._record.modified = self.updated
 
+        # add to store, if new
+        self._dms.add(self._record)
+
         # notify user
         self._action_taken = True
 
@@ -571,10 +784,9 @@ class DropletUpdate(WorkerAction):
         log.error("We cannot fetch the file")
         log.exception(result)
 
-        # self._tmp_file.close()
-        # try:
-        #     os.remove(self._tmp_file.name)
-        # except OSError:
-        #     pass
+        # remove the partial download, see _get_file
+        response = getattr(result, 'value', None)
+        if hasattr(response, 'discard'):
+            response.discard()
 
         raise RetryLater
@@ -115,6 +115,14 @@ def checkbusy(args):
     cmd = {'command':'CHECKBUSY'}
     command_list.append(json.dumps(cmd))
 
+def updateinterval(args):
+    cmd = {'command':'UPDATEINTERVAL'}
+    command_list.append(json.dumps(cmd))
+
+def retries(args):
+    cmd = {'command':'RETRIES'}
+    command_list.append(json.dumps(cmd))
+
 def sethost(args):
     def usage():
         print "Usage: %s sethost http[s]://[host]:[port]/" % sys.argv[0]
@@ -159,6 +167,8 @@ def main():
         'connect':connect,
         'register':register,
         'checkbusy':checkbusy,
+        'updateinterval':updateinterval,
+        'retries':retries,
         'sethost':sethost,
         'deleteuser':deleteuser,
         'addshare':addshare,
@@ -64,10 +64,39 @@ class CommanderCheckBusy(CommanderAction):
         super(CommanderCheckBusy, self).__init__(hub, command)
 
     def __call__(self):
-        return 'Processing: %s, Queue size: %s queued, %s waiting' % (
+        return 'Processing: %s, Queue size: %s queued, %s waiting, ' \
+               'Connections: %s new, %s reused' % (
             self._hub.worker.processing,
-            len(self._hub.queue.queue),
-            len(self._hub.queue.waiting_list)
+            len(self._hub.queue),
+            len(self._hub.queue.waiting_list),
+            self._hub.rest_client.pool.new_connections,
+            self._hub.rest_client.pool.reused_connections
+            )
+
+class CommanderUpdateInterval(CommanderAction):
+    def __init__(self, hub, command):
+        super(CommanderUpdateInterval, self).__init__(hub, command)
+
+    def __call__(self):
+        if self._hub.rest_client.long_poll_supported:
+            return 'Update interval: long polling'
+
+        return 'Update interval: %s seconds' % \
+               self._hub.rest_client.update_interval
+
+class CommanderRetries(CommanderAction):
+    def __init__(self, hub, command):
+        super(CommanderRetries, self).__init__(hub, command)
+
+    def __call__(self):
+        def counts(numbers):
+            return ', '.join('%s %s' % (name, number)
+                             for name, number in sorted(numbers.items())) or 'none'
+
+        return 'Retries: %s, Given up: %s, Dead letters stored: %s' % (
+            counts(self._hub.worker.retries),
+            counts(self._hub.worker.dead_letters),
+            self._hub.database_manager.store.find(db.DeadLetter).count()
             )
 
 class CommanderRegister(CommanderAction):
@@ -101,7 +130,7 @@ class CommanderDeleteUser(CommanderAction):
                     hub.database_manager.store.remove(entry)
                 for entry in hub.database_manager.store.find(db.WatchPath):
                     hub.database_manager.store.remove(entry)
-                hub.database_manager.store.commit()
+                hub.database_manager.commit()
             except:
                 raise
 
@@ -174,4 +203,6 @@ class FooboxCommandReceiver(ServerFactory):
                          'REGISTER':CommanderRegister,
                          'SETHOST':CommanderSetHost,
                          'DELETEUSER':CommanderDeleteUser,
+                         'UPDATEINTERVAL':CommanderUpdateInterval,
+                         'RETRIES':CommanderRetries,
                          }
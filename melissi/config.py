@@ -6,6 +6,29 @@ import os
 import dbschema as db
 
 class ConfigManager:
+    # options of section main with their defaults, used when an
+    # option is missing and written to a new configuration
+    DEFAULTS = {'update_interval': 30,
+                'update_interval_max': 600,
+                'update_page_size': 1000,
+                'workers': 4,
+                'quiet_period': 1,
+                'max_hold': 30,
+                'hash_threads': 2,
+                'hash_chunk_size': 1,
+                'connections_per_host': 4,
+                'connection_idle_timeout': 240,
+                'batch_size': 50,
+                'delta_sync': False,
+                'commit_items': 50,
+                'commit_interval': 1000,
+                'long_poll': True,
+                'long_poll_timeout': 60,
+                'retry_attempts': 10,
+                'retry_max_delay': 600,
+                'large_file_size': 4 * 2**20,
+                }
+
     def __init__(self, hub, config_file):
         self.hub = hub
         self.config_file = config_file
@@ -32,7 +55,16 @@ class ConfigManager:
             self.config.set('main', 'new-root-path',
                             '%s' % os.path.expanduser('~'))
             self.config.set('main', 'resource', '%s' % resource)
-            self.config.set('main', 'update_interval', '30')
+            for option in sorted(self.DEFAULTS):
+                self.config.set('main', option, str(self.DEFAULTS[option]))
+
+            self.config.add_section('database-tuning')
+            for name, value in self.get_database_tuning().iteritems():
+                self.config.set('database-tuning', name, str(value))
+
+            self.config.add_section('lanes')
+            for name, weight in self.get_lane_weights().iteritems():
+                self.config.set('lanes', name, str(weight))
 
             self.write_config()
 
@@ -149,8 +181,8 @@ class ConfigManager:
             record.type = u'str'
             self.hub.database_manager.store.add(record)
 
+        # committed with the GetUpdates action, see Worker.commit
         record.value = unicode(timestamp)
-        self.hub.database_manager.commit()
         return True
 
     def get_timestamp(self):
@@ -160,5 +192,203 @@ class ConfigManager:
         else:
             return str(record.value)
 
+    def _get(self, option):
+        if not self.config.has_option('main', option):
+            return None
+        return self.config.get('main', option)
+
+    def _get_int(self, option, minimum=1):
+        """
+        Return integer `option` of section main, at least `minimum`,
+        or its default if missing
+        """
+        value = self._get(option)
+        if value is None:
+            return self.DEFAULTS[option]
+
+        return max(minimum, int(value))
+
+    def _get_bool(self, option):
+        value = self._get(option)
+        if value is None:
+            return self.DEFAULTS[option]
+
+        return value == 'True'
+
     def get_update_interval(self):
-        return int(self.config.get('main', 'update_interval'))
+        return self._get_int('update_interval')
+
+    def get_update_interval_max(self):
+        """
+        Seconds between updates when nothing changes for a while, see
+        RestClient.poll_updates
+        """
+        return self._get_int('update_interval_max')
+
+    def get_update_page_size(self):
+        """ Cells and droplets fetched in one GetUpdates request """
+        return self._get_int('update_page_size')
+
+    def get_large_file_size(self):
+        """ Files of this many bytes or more are queued in the large lane """
+        return self._get_int('large_file_size')
+
+    def get_lane_weights(self):
+        """
+        Return a dictionary of the weights of the queue lanes, from
+        section lanes, see Queue:
+
+          metadata     deletions, moves and shares
+          small        uploads of small files
+          large        uploads of large files, see get_large_file_size
+          updates      cell and droplet updates from the server
+          maintenance  rescans
+        """
+        weights = {'metadata': 8,
+                   'small': 4,
+                   'updates': 2,
+                   'large': 1,
+                   'maintenance': 1,
+                   }
+
+        if not self.config.has_section('lanes'):
+            return weights
+
+        for name in weights:
+            if self.config.has_option('lanes', name):
+                weights[name] = max(1, int(self.config.get('lanes', name)))
+
+        return weights
+
+    def get_long_poll(self):
+        """
+        Hold a request open until the server has changes, instead of
+        asking for them every update_interval seconds. We fall back to
+        polling at intervals if the server does not support it
+        """
+        return self._get_bool('long_poll')
+
+    def get_long_poll_timeout(self):
+        """ Seconds the server may hold a long poll request """
+        return self._get_int('long_poll_timeout')
+
+    def get_retry_attempts(self):
+        """ Attempts of an action before it is given up, see Worker """
+        return self._get_int('retry_attempts')
+
+    def get_retry_max_delay(self):
+        """ Maximum seconds before an action is retried """
+        return self._get_int('retry_max_delay')
+
+    def get_workers(self):
+        """ Number of actions the worker runs concurrently """
+        return self._get_int('workers')
+
+    def get_quiet_period(self):
+        """
+        Seconds a path must be quiet before its filesystem events are
+        queued. 0 queues events immediately
+        """
+        value = self._get('quiet_period')
+        if value is None:
+            return float(self.DEFAULTS['quiet_period'])
+
+        return max(0.0, float(value))
+
+    def get_max_hold(self):
+        """
+        Seconds the filesystem events of a path that is never quiet,
+        e.g. a log written constantly, are held at most. Never less
+        than the quiet period
+        """
+        value = self._get('max_hold')
+        if value is None:
+            value = self.DEFAULTS['max_hold']
+
+        return max(self.get_quiet_period(), float(value))
+
+    def get_hash_threads(self):
+        """ Number of files hashed concurrently """
+        return self._get_int('hash_threads')
+
+    def get_hash_chunk_size(self):
+        """ Bytes read at once when hashing, configured in MiB (1 - 8) """
+        return min(self._get_int('hash_chunk_size'), 8) * 2**20
+
+    def get_connections_per_host(self):
+        """ Persistent HTTP connections kept open per host """
+        return self._get_int('connections_per_host')
+
+    def get_connection_idle_timeout(self):
+        """ Seconds an idle persistent HTTP connection stays open """
+        return self._get_int('connection_idle_timeout')
+
+    def get_batch_size(self):
+        """ Maximum operations sent in one batch request, 1 disables """
+        return self._get_int('batch_size')
+
+    def get_delta_sync(self):
+        """
+        Upload and download deltas of modified files, see
+        delta.py. The server must speak the same delta format
+        """
+        return self._get_bool('delta_sync')
+
+    def get_commit_items(self):
+        """ Actions committed together to the database, 1 commits each """
+        return self._get_int('commit_items')
+
+    def get_commit_interval(self):
+        """
+        Seconds, configured in milliseconds, before finished actions
+        are committed
+        """
+        return self._get_int('commit_interval', minimum=0) / 1000.0
+
+    def get_database_tuning(self):
+        """
+        Return a dictionary of the SQLite pragmas set when connecting
+        to the database, from section database-tuning:
+
+          journal_mode  WAL, DELETE, TRUNCATE, PERSIST, MEMORY or OFF
+          synchronous   OFF, NORMAL, FULL or EXTRA
+          cache_size    pages, or KiB when negative
+          mmap_size     bytes of the database memory mapped, 0 disables
+          temp_store    DEFAULT, FILE or MEMORY
+          page_size     bytes, applies only to new databases
+
+        The defaults suit a sync client, WAL with synchronous NORMAL
+        may lose the last commits on power loss, but never corrupts
+        the database
+        """
+        tuning = {'journal_mode': 'WAL',
+                  'synchronous': 'NORMAL',
+                  'cache_size': -8192,
+                  'mmap_size': 64 * 2**20,
+                  'temp_store': 'MEMORY',
+                  'page_size': 4096,
+                  }
+        choices = {'journal_mode': ('WAL', 'DELETE', 'TRUNCATE', 'PERSIST',
+                                    'MEMORY', 'OFF'),
+                   'synchronous': ('OFF', 'NORMAL', 'FULL', 'EXTRA'),
+                   'temp_store': ('DEFAULT', 'FILE', 'MEMORY'),
+                   }
+
+        if not self.config.has_section('database-tuning'):
+            return tuning
+
+        for name in tuning:
+            if not self.config.has_option('database-tuning', name):
+                continue
+
+            value = self.config.get('database-tuning', name)
+            if name in choices:
+                value = value.upper()
+                if value not in choices[name]:
+                    raise ValueError("Invalid database-tuning %s: %s" % (name, value))
+            else:
+                value = int(value)
+
+            tuning[name] = value
+
+        return tuning
@@ -11,6 +11,10 @@ SCHEMA_FILE = '''CREATE TABLE file (id INTEGER,
                                     directory BOOL,
                                     watchpath_id INTEGER,
                                     signature BLOB,
+                                    size INTEGER,
+                                    mtime_ns INTEGER,
+                                    inode INTEGER,
+                                    ctime_ns INTEGER,
                                     PRIMARY KEY (id, directory)
                                     );'''
 SCHEMA_WATCHPATH = '''CREATE TABLE watchpath (id INTEGER PRIMARY KEY,
@@ -32,9 +36,50 @@ SCHEMA_LOG = '''CREATE TABLE log (id INTEGER PRIMARY KEY,
                                   file_id INTEGER
                                   );'''
 
-SCHEMA_VERSION = 1
+# actions which failed too many times, see Worker._action_failure
+SCHEMA_DEADLETTER = '''CREATE TABLE deadletter (id INTEGER PRIMARY KEY,
+                                                timestamp DATETIME,
+                                                action TEXT,
+                                                unique_id TEXT,
+                                                attempts INTEGER,
+                                                error TEXT
+                                                );'''
+
+# queued, waiting and retrying actions, see Queue.sync_journal
+SCHEMA_QUEUE = '''CREATE TABLE queue (id INTEGER PRIMARY KEY,
+                                      action TEXT,
+                                      arguments TEXT,
+                                      waiting_id TEXT,
+                                      attempts INTEGER
+                                      );'''
+
+# the path lookups and the children of a directory, see
+# DatabaseManager.get_file_by_path
+SCHEMA_INDEXES = ['CREATE INDEX file_path ON file (watchpath_id, filename)',
+                  'CREATE INDEX file_parent ON file (parent_id)',
+                  ]
+
+SCHEMA_VERSION = 5
+
+# statements to upgrade the schema from the previous version
+SCHEMA_UPGRADES = {
+    2: ['ALTER TABLE file ADD COLUMN size INTEGER',
+        'ALTER TABLE file ADD COLUMN mtime_ns INTEGER',
+        'ALTER TABLE file ADD COLUMN inode INTEGER',
+        'ALTER TABLE file ADD COLUMN ctime_ns INTEGER',
+        ],
+    3: SCHEMA_INDEXES,
+    4: [SCHEMA_DEADLETTER],
+    5: [SCHEMA_QUEUE],
+    }
 
 class File(object):
+    """
+    A file or directory. `filename` is the path relative to the
+    watchpath, a materialized path, and `parent_id` points to the
+    directory that contains it. See DatabaseManager.get_ancestors,
+    get_descendants and the *_subtree methods for tree operations
+    """
     __storm_table__ = "file"
     __storm_primary__ = "id", "directory"
     id = Int()
@@ -48,6 +93,20 @@ class File(object):
     watchpath_id = Int()
     signature = Pickle()
 
+    # stat of the file when we last knew its hash, see util.get_stat
+    size = Int()
+    mtime_ns = Int()
+    inode = Int()
+    ctime_ns = Int()
+
+    @property
+    def stat(self):
+        return (self.size, self.mtime_ns, self.inode, self.ctime_ns)
+
+    @stat.setter
+    def stat(self, value):
+        self.size, self.mtime_ns, self.inode, self.ctime_ns = value
+
 class WatchPath(object):
     __storm_table__ = "watchpath"
     id = Int(primary=True)
@@ -76,4 +135,25 @@ class LogEntry(object):
     file_id = Int()
     file = Reference(file_id, File.id)
 
+class DeadLetter(object):
+    __storm_table__ = "deadletter"
+    id = Int(primary=True)
+    timestamp = DateTime()
+    action = Unicode()
+    unique_id = Unicode()
+    attempts = Int()
+    error = Unicode()
+
+class QueueEntry(object):
+    """
+    A queued action. `arguments` and `waiting_id` are JSON, see
+    WorkerAction.arguments
+    """
+    __storm_table__ = "queue"
+    id = Int(primary=True)
+    action = Unicode()
+    arguments = Unicode()
+    waiting_id = Unicode()
+    attempts = Int()
+
 File.watchpath = Reference(File.watchpath_id, WatchPath.id)
@@ -1,56 +1,403 @@
+# standard modules
+import sqlite3
+from collections import OrderedDict
+import logging
+log = logging.getLogger("melissilogger")
+
+# extra modules
+from storm.expr import Select, SQL
+from storm.uri import URI
+from storm.info import get_obj_info
+from storm.store import PENDING_REMOVE
+
 # melissi modules
 from dbschema import *
 
+class RecordCache(object):
+    """
+    A bounded LRU cache of File records. Records are validated when
+    found, because they may be renamed, moved or removed while
+    cached, see DatabaseManager.get_file_by_path
+    """
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._records = OrderedDict()
+
+    def get(self, key):
+        record = self._records.pop(key, None)
+        if record is None:
+            self.misses += 1
+            return None
+
+        # most recently used go last
+        self._records[key] = record
+        self.hits += 1
+        return record
+
+    def put(self, key, record):
+        self._records.pop(key, None)
+        self._records[key] = record
+        while len(self._records) > self.size:
+            self._records.popitem(last=False)
+
+    def discard(self, key):
+        self._records.pop(key, None)
+
+    def clear(self):
+        self._records.clear()
+
+    def __len__(self):
+        return len(self._records)
+
 class DatabaseManager():
+    # how many File records to keep in the record cache
+    RECORD_CACHE_SIZE = 4096
+
     def __init__(self, hub, database_file):
         self.hub = hub
         self.database_file = database_file
+        self.record_cache = RecordCache(self.RECORD_CACHE_SIZE)
+        self._savepoint = False
         self.connect_db()
 
     def connect_db(self):
+        uri = URI(self.database_file)
+        tuning = {}
+        if self.hub.config_manager:
+            tuning = self.hub.config_manager.get_database_tuning()
+
+        if uri.scheme == 'sqlite' and uri.database and \
+           uri.database != ':memory:':
+            # the page size applies only to a new database, and the
+            # journal mode sticks to the database file, but it cannot
+            # change inside the transaction Storm opens, so set them
+            # before. With WAL readers don't block the writer and a
+            # commit does not rewrite the journal
+            connection = sqlite3.connect(uri.database)
+            for name in ('page_size', 'journal_mode'):
+                if name in tuning:
+                    connection.execute('PRAGMA %s=%s' % (name, tuning[name]))
+            connection.close()
+
+        # synchronous cannot change inside a transaction either, Storm
+        # sets it when connecting
+        if 'synchronous' in tuning:
+            uri.options.setdefault('synchronous', tuning['synchronous'])
+
         # check if database exists
-        self.database = create_database(self.database_file)
+        self.database = create_database(uri)
         self.store = Store(self.database)
 
+        # per connection settings
+        for name in ('cache_size', 'mmap_size', 'temp_store'):
+            if name in tuning:
+                self.store.execute('PRAGMA %s=%s' % (name, tuning[name]))
+
         # if database is new, we have to create schema
         self._check_schema()
 
     def _check_schema(self):
         try:
             version = self.store.find(Config, Config.name == u'version').one()
-            if version < SCHEMA_VERSION:
-                self._upgrade_schema()
         except:
             self._create_schema()
+            return SCHEMA_VERSION
+
+        if int(version.value) < SCHEMA_VERSION:
+            self._upgrade_schema(version)
 
         return SCHEMA_VERSION
 
     def clear_all(self):
         self.store.execute("DELETE FROM file")
+        self.store.invalidate()
+        self.record_cache.clear()
 
-    def _upgrade_schema(self):
-        # TODO
-        store.commit()
+    def _upgrade_schema(self, version):
+        for number in range(int(version.value) + 1, SCHEMA_VERSION + 1):
+            for statement in SCHEMA_UPGRADES[number]:
+                self.store.execute(statement)
+
+        version.value = unicode(SCHEMA_VERSION)
+        self.store.commit()
         return True
 
+    def get_file_by_path(self, watchpath, filename):
+        """
+        Return the File `filename` of the WatchPath with path
+        `watchpath`, or None. Uses the file_path index; SQLite does
+        not use it when file is joined with watchpath, so look up the
+        watchpath id in a subselect
+        """
+        key = ('path', watchpath, filename)
+        record = self.record_cache.get(key)
+        if record is not None:
+            if self._valid(record) and record.filename == filename and \
+               record.watchpath.path == watchpath:
+                return record
+            self.record_cache.discard(key)
+
+        record = self.store.find(File,
+                                 File.watchpath_id == Select(WatchPath.id,
+                                                             WatchPath.path == watchpath),
+                                 File.filename == filename
+                                 ).one()
+        if record is not None:
+            self.record_cache.put(key, record)
+        return record
+
+    def get_file_by_id(self, id, directory):
+        """
+        Return the File with `id`, a directory or not, or None. Uses
+        the primary key, and the records the store already holds
+        """
+        key = ('id', id, directory)
+        record = self.record_cache.get(key)
+        if record is not None:
+            if self._valid(record) and record.id == id and \
+               record.directory == directory:
+                return record
+            self.record_cache.discard(key)
+
+        record = self.store.get(File, (id, directory))
+        if record is not None:
+            self.record_cache.put(key, record)
+        return record
+
+    def _subtree_range(self, filename):
+        # descendants of `filename` sort between 'filename/' and
+        # 'filename0', '0' being the character after '/', so the
+        # file_path index finds them with a range scan. LIKE does not
+        # use the index
+        return (filename + u'/', filename + u'0')
+
+    def _subtree(self, watchpath_id, filename=None):
+        # the descendants of directory `filename`, or everything in
+        # the watchpath
+        conditions = [File.watchpath_id == watchpath_id]
+        if filename:
+            start, end = self._subtree_range(filename)
+            conditions += [File.filename >= start, File.filename < end]
+
+        return conditions
+
+    def get_ancestors(self, record):
+        """
+        Return the directories that contain `record`, from the top
+        one down. Every ancestor is found through the file_path index
+        """
+        parts = record.filename.split(u'/')[:-1]
+        filenames = [u'/'.join(parts[:i]) for i in range(1, len(parts) + 1)]
+        if not filenames:
+            return []
+
+        return list(self.store.find(File,
+                                    File.watchpath_id == record.watchpath_id,
+                                    File.filename.is_in(filenames),
+                                    File.directory == True
+                                    ).order_by(File.filename))
+
+    def get_descendants(self, watchpath_id, filename=None, max_depth=None):
+        """
+        Return the records below directory `filename` of watchpath
+        `watchpath_id`, or all its records if `filename` is None, up
+        to `max_depth` levels down. The records are ordered by
+        filename, so a directory comes before its contents
+        """
+        conditions = self._subtree(watchpath_id, filename)
+        if max_depth:
+            # the depth is the number of '/' in filename
+            depth = max_depth - 1
+            if filename:
+                depth += filename.count(u'/') + 1
+            conditions.append(SQL("length(file.filename) - "
+                                  "length(replace(file.filename, '/', '')) <= ?",
+                                  (depth,)))
+
+        return self.store.find(File, *conditions).order_by(File.filename)
+
+    def get_subtree_size(self, watchpath_id, filename=None):
+        """
+        Return the number of records below directory `filename`, see
+        get_descendants
+        """
+        return self.store.find(File, *self._subtree(watchpath_id, filename)).count()
+
+    def rename_subtree(self, watchpath_id, filename,
+                       new_watchpath_id, new_filename):
+        """
+        Move all descendants of directory `filename` of watchpath
+        `watchpath_id` under `new_filename` of `new_watchpath_id`, in
+        one statement. The directory itself is not changed. Return the
+        number of records changed
+        """
+        start, end = self._subtree_range(filename)
+
+        # write pending changes before we change the table under
+        # Storm's feet, and reload all records afterwards
+        self.store.flush()
+        result = self.store.execute(
+            "UPDATE file SET filename = ? || substr(filename, ?), "
+            "watchpath_id = ? "
+            "WHERE watchpath_id = ? AND filename >= ? AND filename < ?",
+            (new_filename + u'/', len(start) + 1, new_watchpath_id,
+             watchpath_id, start, end))
+        self.store.invalidate()
+        self.record_cache.clear()
+
+        return result.rowcount
+
+    def delete_subtree(self, watchpath_id, filename):
+        """
+        Delete all descendants of directory `filename` of watchpath
+        `watchpath_id`, in one statement. The directory itself is not
+        deleted. Return the number of records deleted
+        """
+        start, end = self._subtree_range(filename)
+
+        self.store.flush()
+        result = self.store.execute(
+            "DELETE FROM file "
+            "WHERE watchpath_id = ? AND filename >= ? AND filename < ?",
+            (watchpath_id, start, end))
+        self.store.invalidate()
+        self.record_cache.clear()
+
+        return result.rowcount
+
+    def _valid(self, record):
+        # a cached record is still ours, and not removed
+        obj_info = get_obj_info(record)
+        return obj_info.get('store') is self.store and \
+               obj_info.get('pending') != PENDING_REMOVE
+
     def commit(self):
+        # records stay valid after a commit, so keep them cached;
+        # renamed or removed ones are dropped when found, see _valid
         self.store.commit()
+        self._savepoint = False
 
     def rollback(self):
+        # records changed since the last commit are reloaded, or are
+        # gone if they were added
         self.store.rollback()
+        self.record_cache.clear()
+        self._savepoint = False
+
+    def savepoint(self):
+        """
+        Keep the changes made so far when rolling back with
+        rollback_to_savepoint, without committing them
+        """
+        self.store.flush()
+        if self._savepoint:
+            self.store.execute('RELEASE SAVEPOINT item', noresult=True)
+        self.store.execute('SAVEPOINT item', noresult=True)
+        self._savepoint = True
+
+    def rollback_to_savepoint(self):
+        """
+        Undo the changes made after the last savepoint, or after the
+        last commit if there is none
+        """
+        if not self._savepoint:
+            self.rollback()
+            return
+
+        try:
+            # the changes Storm holds in memory go to the database
+            # first, to be undone with the rest
+            self.store.flush()
+            self.store.execute('ROLLBACK TO SAVEPOINT item', noresult=True)
+        except Exception, e:
+            log.warning("Rolling back all uncommitted changes: %s" % e)
+            self.rollback()
+            return
+
+        self.store.invalidate()
+        self.record_cache.clear()
 
     def _create_schema(self):
         self.store.execute(SCHEMA_FILE)
         self.store.execute(SCHEMA_WATCHPATH)
         self.store.execute(SCHEMA_CONFIG)
         self.store.execute(SCHEMA_LOG)
+        self.store.execute(SCHEMA_DEADLETTER)
+        self.store.execute(SCHEMA_QUEUE)
+        for statement in SCHEMA_INDEXES:
+            self.store.execute(statement)
 
         version = Config()
         version.name = u'version'
         version.type = u'int'
-        version.value = u'1'
+        version.value = unicode(SCHEMA_VERSION)
         self.store.add(version)
 
         self.commit()
 
+def benchmark(rows=10**6, lookups=10**4):
+    """
+    Print the time of `lookups` path and id lookups in a file table
+    of `rows` rows, using the old generic query and get_file_by_path /
+    get_file_by_id
+    """
+    import os
+    import random
+    import tempfile
+    import time
+
+    class Hub(object):
+        config_manager = None
+
+    fd, database_file = tempfile.mkstemp(prefix='melissi-', suffix='.db')
+    os.close(fd)
+    manager = DatabaseManager(Hub(), 'sqlite:%s' % database_file)
+    store = manager.store
+
+    store.execute("INSERT INTO watchpath (id, path) VALUES (1, '/tmp/melissi')")
+    for first in xrange(0, rows, 500):
+        store.execute("INSERT INTO file (id, filename, directory, parent_id, "
+                      "watchpath_id) VALUES %s" %
+                      ', '.join("(%d, 'dir%d/file%d', 0, %d, 1)" %
+                                (i, i // 100, i, i // 100)
+                                for i in xrange(first, min(first + 500, rows))))
+    manager.commit()
+
+    ids = [random.randrange(rows) for _ in xrange(lookups)]
+
+    def generic(i):
+        # what WorkerAction._fetch_file_record does, a join which
+        # scans the file table with or without indexes
+        return store.find(File, WatchPath.id == File.watchpath_id,
+                          File.filename == u'dir%d/file%d' % (i // 100, i),
+                          WatchPath.path == u'/tmp/melissi').one()
+
+    def by_path(i):
+        return manager.get_file_by_path(u'/tmp/melissi',
+                                        u'dir%d/file%d' % (i // 100, i))
+
+    def by_id(i):
+        return manager.get_file_by_id(i, False)
+
+    def run(name, function, sample):
+        start = time.time()
+        for i in sample:
+            function(i)
+        elapsed = time.time() - start
+        print "%-8s %8.3f ms per lookup" % (name, 1000 * elapsed / len(sample))
+
+    run('generic', generic, ids[:max(lookups // 1000, 1)])
+    run('path', by_path, ids)
+    # the last ones are still in the record cache
+    run('cached', by_path, ids[-100:])
+    store.invalidate()
+    manager.record_cache.clear()
+    run('id', by_id, ids)
+
+    os.unlink(database_file)
 
+if __name__ == '__main__':
+    import sys
+    benchmark(*map(int, sys.argv[1:]))
@@ -0,0 +1,288 @@
+# rsync style delta encoding
+#
+# A signature holds a weak rolling checksum (adler32) and a strong
+# checksum (md5) for every full block of a file. Using the signature
+# of the old version of a file, delta() finds the blocks of the new
+# version that already exist in the old one and encodes the new
+# version as a list of block copies and literal data. patch()
+# rebuilds the new version from the old one and the delta.
+#
+# Delta format:
+#   'MLSD' + block size (4 bytes)
+#   'C' + first block (4 bytes) + number of blocks (4 bytes)
+#   'D' + length (4 bytes) + literal data
+# all numbers are unsigned, big endian
+
+# standard modules
+import os
+import sys
+import math
+import struct
+import zlib
+import hashlib
+
+MAGIC = 'MLSD'
+MIN_BLOCK_SIZE = 2048
+MAX_BLOCK_SIZE = 2**16
+READ_SIZE = 2**20
+MAX_LITERAL = 2**20
+# the window rolls through literal data one byte at a time in Python,
+# about 2MB per second, see delta()
+MAX_ROLLED = 2**22
+_MOD_ADLER = 65521
+
+class TooDifferent(Exception):
+    """ The new file shares too little with the old one, see delta() """
+
+def block_size_for(size):
+    """ Return a block size, about the square root of `size` """
+    block_size = int(math.sqrt(size)) & ~1023
+    return min(max(block_size, MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+
+def _weak(block):
+    return zlib.adler32(block) & 0xffffffff
+
+def _strong(block):
+    return hashlib.md5(block).digest()
+
+class SignatureBuilder(object):
+    """
+    Build a signature from data fed in chunks of any size, so that
+    a signature can be calculated while the file is read for another
+    reason, e.g. uploading. See util.HashingFile
+    """
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self._blocks = []
+        self._buffer = ''
+
+    def update(self, data):
+        data = self._buffer + data
+        end = len(data) - len(data) % self.block_size
+        for offset in xrange(0, end, self.block_size):
+            block = data[offset:offset + self.block_size]
+            self._blocks.append((_weak(block), _strong(block)))
+
+        self._buffer = data[end:]
+
+    def signature(self):
+        return {'block_size': self.block_size,
+                'blocks': self._blocks
+                }
+
+def signature(f, block_size=None):
+    """ Return the signature of file object `f` """
+    if not block_size:
+        block_size = block_size_for(os.fstat(f.fileno()).st_size)
+
+    builder = SignatureBuilder(block_size)
+    while True:
+        chunk = f.read(READ_SIZE)
+        if not chunk:
+            break
+        builder.update(chunk)
+
+    return builder.signature()
+
+class _DeltaWriter(object):
+    def __init__(self, out, block_size):
+        self._out = out
+        self._copy = None
+        self.length = 0
+        self.literal_length = 0
+
+        self._write(MAGIC + struct.pack('>I', block_size))
+
+    def _write(self, data):
+        self._out.write(data)
+        self.length += len(data)
+
+    def _flush_copy(self):
+        if self._copy:
+            self._write('C' + struct.pack('>II', *self._copy))
+            self._copy = None
+
+    def copy(self, index):
+        if self._copy and self._copy[0] + self._copy[1] == index:
+            self._copy = (self._copy[0], self._copy[1] + 1)
+        else:
+            self._flush_copy()
+            self._copy = (index, 1)
+
+    def literal(self, data):
+        if not data:
+            return
+
+        self._flush_copy()
+        self.literal_length += len(data)
+        for offset in xrange(0, len(data), MAX_LITERAL):
+            piece = data[offset:offset + MAX_LITERAL]
+            self._write('D' + struct.pack('>I', len(piece)) + piece)
+
+    def close(self):
+        self._flush_copy()
+
+def delta(signature, f, out, max_literal=None):
+    """
+    Write to `out` the delta that turns the file with `signature`
+    into the contents of file object `f`. Return the length of the
+    delta. Raise TooDifferent when more than `max_literal` bytes
+    of `f` match no block, sending the whole file is cheaper then
+    """
+    block_size = signature['block_size']
+    blocks = {}
+    for index, (weak, strong) in enumerate(signature['blocks']):
+        blocks.setdefault(weak, {}).setdefault(strong, index)
+
+    writer = _DeltaWriter(out, block_size)
+    if not blocks:
+        # nothing to match, e.g. the old file was smaller than a block
+        while True:
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                break
+            writer.literal(chunk)
+            _check_literal(writer, max_literal)
+        writer.close()
+        return writer.length
+
+    buf = ''
+    pos = 0
+    literal_start = 0
+    weak = None
+    eof = False
+
+    while True:
+        if len(buf) - pos <= block_size and not eof:
+            # keep the window and the next byte in the buffer
+            writer.literal(buf[literal_start:pos])
+            _check_literal(writer, max_literal)
+            chunk = f.read(READ_SIZE)
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = literal_start = 0
+            continue
+
+        if len(buf) - pos < block_size:
+            break
+
+        if weak is None:
+            # fast path, after a match or at the start
+            weak = _weak(buf[pos:pos + block_size])
+            a = weak & 0xffff
+            b = weak >> 16
+
+        candidates = blocks.get(weak)
+        if candidates:
+            index = candidates.get(_strong(buf[pos:pos + block_size]))
+            if index is not None:
+                writer.literal(buf[literal_start:pos])
+                writer.copy(index)
+                pos += block_size
+                literal_start = pos
+                weak = None
+                continue
+
+        if pos + block_size == len(buf):
+            # end of file, nothing to roll into
+            break
+
+        # roll the window one byte
+        out_byte = ord(buf[pos])
+        in_byte = ord(buf[pos + block_size])
+        a = (a - out_byte + in_byte) % _MOD_ADLER
+        b = (b - block_size * out_byte + a - 1) % _MOD_ADLER
+        weak = (b << 16) | a
+        pos += 1
+
+    writer.literal(buf[literal_start:])
+    writer.close()
+
+    return writer.length
+
+def _check_literal(writer, max_literal):
+    if max_literal is not None and writer.literal_length > max_literal:
+        raise TooDifferent("%s bytes do not match" % writer.literal_length)
+
+def patch(delta_file, old, out):
+    """
+    Write to `out` the file built from file object `old` and the
+    delta read from `delta_file`. Raise ValueError for an invalid
+    delta
+    """
+    header = delta_file.read(8)
+    if len(header) != 8 or header[:4] != MAGIC:
+        raise ValueError("Invalid delta header")
+    block_size = struct.unpack('>I', header[4:])[0]
+
+    def read_exactly(f, length):
+        data = f.read(length)
+        if len(data) != length:
+            raise ValueError("Truncated delta")
+        return data
+
+    while True:
+        op = delta_file.read(1)
+        if not op:
+            break
+
+        if op == 'C':
+            index, count = struct.unpack('>II', read_exactly(delta_file, 8))
+            old.seek(index * block_size)
+            remaining = count * block_size
+            while remaining:
+                chunk = read_exactly(old, min(remaining, READ_SIZE))
+                out.write(chunk)
+                remaining -= len(chunk)
+
+        elif op == 'D':
+            length = struct.unpack('>I', read_exactly(delta_file, 4))[0]
+            out.write(read_exactly(delta_file, length))
+
+        else:
+            raise ValueError("Invalid delta operation %r" % op)
+
+def benchmark(size=2**24, changes=16):
+    """
+    Print the bytes a delta needs compared to the full file, for a
+    random file of `size` bytes with `changes` small edits
+    """
+    import random
+    import tempfile
+    import time
+
+    old = os.urandom(size)
+    new = bytearray(old)
+    for _ in xrange(changes):
+        offset = random.randrange(size)
+        new[offset:offset] = os.urandom(random.randrange(1, 100))
+    new = str(new)
+
+    old_file = tempfile.TemporaryFile()
+    old_file.write(old)
+    old_file.seek(0)
+    new_file = tempfile.TemporaryFile()
+    new_file.write(new)
+    new_file.seek(0)
+    delta_file = tempfile.TemporaryFile()
+    patched = tempfile.TemporaryFile()
+
+    start = time.time()
+    old_signature = signature(old_file)
+    signature_time = time.time() - start
+
+    start = time.time()
+    length = delta(old_signature, new_file, delta_file)
+    delta_time = time.time() - start
+
+    delta_file.seek(0)
+    patch(delta_file, old_file, patched)
+    patched.seek(0)
+    assert patched.read() == new
+
+    print "file %d bytes, delta %d bytes (%.2f%%)" % (len(new), length,
+                                                     100.0 * length / len(new))
+    print "signature %.2fs, delta %.2fs" % (signature_time, delta_time)
+
+if __name__ == '__main__':
+    benchmark(*map(int, sys.argv[1:]))
@@ -0,0 +1,120 @@
+# incremental JSON parsing
+#
+# iterparse() reads a JSON object from a file in chunks and yields its
+# members one by one, so that big replies, like a full status update,
+# are processed without loading them in memory at once. Elements of
+# the arrays we ask for are yielded one by one too.
+
+# standard modules
+import json
+
+CHUNK_SIZE = 2**16
+WHITESPACE = ' \t\n\r'
+# characters which may follow a value
+DELIMITERS = WHITESPACE + ',:]}'
+
+_decoder = json.JSONDecoder()
+
+class _Buffer(object):
+    def __init__(self, f, chunk_size):
+        self._file = f
+        self._chunk_size = chunk_size
+        self.data = ''
+        self.pos = 0
+        self.eof = False
+
+    def _read(self):
+        chunk = self._file.read(self._chunk_size)
+        if not chunk:
+            self.eof = True
+
+        # forget what we parsed
+        self.data = self.data[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        """ Return the next character which is not whitespace """
+        while True:
+            while self.pos < len(self.data) and \
+                  self.data[self.pos] in WHITESPACE:
+                self.pos += 1
+
+            if self.pos < len(self.data):
+                return self.data[self.pos]
+
+            if self.eof:
+                raise ValueError("Unexpected end of JSON data")
+            self._read()
+
+    def skip(self, character):
+        if self.peek() != character:
+            raise ValueError("Expected '%s' at %r" %
+                             (character, self.data[self.pos:self.pos + 20]))
+        self.pos += 1
+
+    def decode(self):
+        """ Decode the next value, reading until it is complete """
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.data, self.pos)
+
+                # a number may continue in the next chunk, e.g. '1' of
+                # '1.5e3', it is complete only when a delimiter follows
+                if self.eof or not isinstance(value, (int, long, float)) or \
+                   (end < len(self.data) and self.data[end] in DELIMITERS):
+                    break
+            except ValueError:
+                if self.eof:
+                    raise
+            self._read()
+
+        self.pos = end
+        return value
+
+def iterparse(f, arrays=(), values=(), chunk_size=CHUNK_SIZE):
+    """
+    Yield (name, value) for the members of the JSON object read from
+    file object `f`. Members which are objects are not yielded, their
+    members are instead, unless they are named in `values`. The
+    elements of arrays named in `arrays` are yielded one by one as
+    (name, element).
+    """
+    data = _Buffer(f, chunk_size)
+    data.skip('{')
+
+    # (kind, name) of the objects and arrays we are in
+    stack = [('object', None)]
+    while stack:
+        kind, name = stack[-1]
+        character = data.peek()
+
+        if character == ',':
+            data.pos += 1
+
+        elif kind == 'object':
+            if character == '}':
+                data.pos += 1
+                stack.pop()
+                continue
+
+            member = data.decode()
+            data.skip(':')
+
+            character = data.peek()
+            if character == '{' and member not in values:
+                data.pos += 1
+                stack.append(('object', member))
+            elif character == '[' and member in arrays:
+                data.pos += 1
+                stack.append(('array', member))
+            else:
+                yield member, data.decode()
+
+        else:
+            if character == ']':
+                data.pos += 1
+                stack.pop()
+                continue
+
+            yield name, data.decode()
@@ -12,9 +12,9 @@ import notifier
 import worker
 import config
 import restclient
-import watchdog
 import commander
 import queue
+import util
 import twisted
 import logging
 
@@ -31,7 +31,6 @@ class Hub(object):
         self.notify_manager = None
         self.queue = None
         self.rest_client = None
-        self.watch_dog = None
 
 
 def setup_logging(level):
@@ -89,16 +88,18 @@ def main():
         setup_logging(30)
 
     hub = Hub()
-    hub.queue = queue.Queue(hub)
     hub.config_manager = config.ConfigManager(hub,
                                               os.path.expanduser(options.config_file))
+    hub.queue = queue.Queue(hub)
     hub.database_manager = database.DatabaseManager(hub, hub.config_manager.get_database())
+    util.start_hash_pool(hub.config_manager.get_hash_threads(),
+                         hub.config_manager.get_hash_chunk_size())
     hub.notify_manager = notifier.NotifyManager(hub)
     hub.desktop_tray = desktop.DesktopTray(hub,
                                            disable=hub.config_manager.config.get('main', 'no-desktop') == 'True' or options.no_desktop)
     hub.worker = worker.Worker(hub)
+    hub.queue.restore()
     hub.rest_client = restclient.RestClient(hub)
-    hub.watch_dog = watchdog.WatchDog(hub)
 
     # enable commander
     command_receiver = commander.FooboxCommandReceiver(hub)
@@ -1,6 +1,7 @@
 # standard modules
 import os
 import sys
+from collections import OrderedDict
 from os.path import join as pathjoin
 import logging
 log = logging.getLogger("melissilogger")
@@ -195,6 +196,10 @@ class NotifyManager():
         self.hub = hub
         self._dms = self.hub.database_manager.store
         self.open_files_list = []
+        self._quiet_period = self.hub.config_manager.get_quiet_period()
+        self._max_hold = self.hub.config_manager.get_max_hold()
+        self._pending = OrderedDict()
+        self._flush_call = None
         self._inotify_wm = pyinotify.WatchManager()
         self._processor = HandleEvents(self)
         self._inotify_notifier = pyinotify.Notifier(self._inotify_wm, self._processor)
@@ -202,9 +207,11 @@ class NotifyManager():
                                 self._inotify_wm, self._inotify_notifier)
         self.watch_list = []
         for record in self._dms.find(db.WatchPath):
-            reactor.callWhenRunning(self.add_watch, record.path)
+            # nothing downloads yet, so temporary files are leftovers
+            # of a crash
+            reactor.callWhenRunning(self.add_watch, record.path, True)
 
-    def add_watch(self, directory):
+    def add_watch(self, directory, remove_temporary=False):
         log.log(5, "Adding [%s]" % directory)
         log.log(5, "Adding expanded [%s]" % os.path.abspath(os.path.expanduser(directory)))
         directory = os.path.abspath(directory)
@@ -223,7 +230,7 @@ class NotifyManager():
                     log.warning("Cannot watch %s, skipping" % directory)
                 else:
                     # scan for new files
-                    self.scan_directory(d)
+                    self.scan_directory(d, remove_temporary)
 
 
     def rescan_directories(self, directories=None):
@@ -269,7 +276,12 @@ class NotifyManager():
 
         #return False
 
-    def scan_directory(self, directory):
+    def scan_directory(self, directory, remove_temporary=False):
+        """
+        Queue the changes made in `directory` while we were not
+        watching. With `remove_temporary` remove the temporary files
+        of downloads and patches, see util.TEMP_PREFIX, too
+        """
         # check for creations / modifictions
         for root, dirs, files in os.walk(directory):
             # process directories
@@ -280,6 +292,11 @@ class NotifyManager():
                                   )
             # process files
             for name in files:
+                if remove_temporary and util.is_temporary(name) and \
+                   name.endswith('.tmp'):
+                    self._remove(pathjoin(root, name))
+                    continue
+
                 f, w = self.path_split(pathjoin(root, name))
                 self.add_to_queue(ModifyFile(self.hub, f, w),
                                   pathjoin(w, f)
@@ -290,26 +307,114 @@ class NotifyManager():
         if watchpath:
             # only do this procedure with watchpath's
             # find file in watched path
-            query = self._dms.find(db.File,
-                                   db.WatchPath.id == watchpath.id,
-                                   db.WatchPath.id == db.File.watchpath_id)
-            for f in query:
+            # directories come before their contents, so we skip the
+            # contents of deleted directories, DeleteDir removes them
+            deleted = ()
+            for f in self.hub.database_manager.get_descendants(watchpath.id):
+                if f.filename.startswith(deleted):
+                    continue
+
                 fullpath = pathjoin(watchpath.path, f.filename)
                 if not os.path.exists(fullpath):
                     # the file got delete while we
                     # where not watching
                     if f.directory:
+                        deleted += (f.filename + u'/',)
                         self.add_to_queue(DeleteDir(self.hub, f.filename, watchpath.path),
                                           fullpath)
                     else:
                         self.add_to_queue(DeleteFile(self.hub, f.filename, watchpath.path),
                                           fullpath)
 
+    def _remove(self, pathname):
+        log.debug("Removing temporary file %s" % pathname)
+        try:
+            os.unlink(pathname)
+        except OSError, error_message:
+            log.warning("Cannot remove %s: %s" % (pathname, error_message))
+
     def add_to_queue(self, action, pathname):
         # print self.open_files_list
-        if pathname not in self.open_files_list:
+        if pathname in self.open_files_list:
+            return
+
+        # ignore our temporary files, e.g. when patching
+        if util.is_temporary(pathname) or \
+           (isinstance(action, MoveObject) and \
+            util.is_temporary(action.old_filename)):
+            return
+
+        self.hub.rest_client.update_activity()
+
+        if self._quiet_period and \
+           isinstance(action, (ModifyFile, DeleteFile, CreateDir, DeleteDir)):
+            self._hold(action, pathname)
+
+        else:
+            # keep the order of the held actions on the paths we touch
+            if isinstance(action, MoveObject):
+                self._release(pathjoin(action.watchpath, action.old_filename))
+            self._release(pathname)
+
             self.hub.queue.put(action)
 
+    def _hold(self, action, pathname):
+        """
+        Keep `action` until `pathname` is quiet for
+        self._quiet_period seconds, but no longer than self._max_hold
+        seconds after its first action, so that a file which is
+        written constantly is still uploaded. A newer action on the
+        same path replaces the held one, since actions check the
+        filesystem when they execute, the last one is the net
+        result. E.g. ten saves of a file result in one ModifyFile and
+        a created and deleted file in a DeleteFile which does nothing.
+        """
+        pending = self._pending.get(pathname)
+        if pending and \
+               isinstance(pending[0], (CreateDir, DeleteDir)) != \
+               isinstance(action, (CreateDir, DeleteDir)):
+            # a file replaced by a directory or the other way round,
+            # we need both actions
+            self._release(pathname)
+            pending = None
+
+        now = reactor.seconds()
+        if pending:
+            log.log(5, "Coalescing %s with %s" % (action.action_name,
+                                                  pending[0].action_name))
+            first = pending[1]
+        else:
+            first = now
+
+        self._pending[pathname] = (action, first, now)
+
+        if not (self._flush_call and self._flush_call.active()):
+            self._flush_call = reactor.callLater(self._quiet_period,
+                                                 self._flush)
+
+    def _release(self, pathname):
+        try:
+            action = self._pending.pop(pathname)[0]
+        except KeyError:
+            return
+
+        self.hub.queue.put(action)
+
+    def _due(self, first, last):
+        """ Return when a path held since `first` is released """
+        return min(last + self._quiet_period, first + self._max_hold)
+
+    def _flush(self):
+        now = reactor.seconds()
+        for pathname, (_, first, last) in self._pending.items():
+            if self._due(first, last) <= now:
+                self._release(pathname)
+
+        if self._pending:
+            due = min(self._due(first, last)
+                      for _, first, last in self._pending.itervalues())
+            self._flush_call = reactor.callLater(due - now, self._flush)
+
     def add_to_file_list(self, event):
         self.open_files_list.append(event.pathname)
 
@@ -13,8 +13,6 @@ from twisted.protocols import basic
 from twisted.web import iweb
 from zope.interface import implements
 
-# import librsync
-
 class MultiPartProducer():
     """ A producer that sends files and parameters as a multi part request
 
@@ -24,15 +22,20 @@ class MultiPartProducer():
     implements(iweb.IBodyProducer)
     CHUNK_SIZE = 2**14
 
-    def __init__(self, data=None, file_handle=None, deferred=None):
+    def __init__(self, data=None, file_handle=None, deferred=None,
+                 digest_field=None):
         """ Initializes the producer
 
         files is a file descriptor
         deferred = a deferred
+        digest_field = name of a field sent after the file, with
+        value file_handle.hexdigest(). Use with util.HashingFile to
+        hash the file while sending it
 
-        The procuder performs a seek(0) to the file
+        The file is read from its current position
         """
         self._file = file_handle
+        self._digest_field = digest_field
         if self._file:
             self._file_length = self._file_size(self._file)
         else:
@@ -49,6 +52,7 @@ class MultiPartProducer():
         self.length = self._file_length + len(self.head) + len(self.tail)
         self._sent = 0
         self._paused = False
+        self._digest_sent = False
 
     def _generate_boundary(self):
         boundary = "------------------------------"
@@ -58,15 +62,25 @@ class MultiPartProducer():
         return boundary
 
     def _generate_tail(self):
-        if self.head:
-            return  '\r\n--%s--\r\n' % self.boundary
-        else:
+        if not self.head:
             return ''
 
+        tail = '\r\n'
+        if self._digest_field:
+            # the digest is not known yet, but it's always of the
+            # same length, so use the digest of nothing to calculate
+            # the length of the request
+            tail += '--%s\r\n' % self.boundary
+            tail += 'Content-Disposition: form-data; name="%s"\r\n\r\n' % self._digest_field
+            tail += '%s\r\n' % self._file.hexdigest()
+        tail += '--%s--\r\n' % self.boundary
+
+        return tail
+
     def _generate_head(self):
         postdata = ""
         if self._data or self._file:
-            postdata += '%s\r\n' % self.boundary
+            postdata += '--%s\r\n' % self.boundary
 
             for key, value in self._data.items():
                 postdata += 'Content-Disposition: form-data; name="%s"\r\n\r\n' % key
@@ -134,6 +148,11 @@ class MultiPartProducer():
                 chunk += str(self._file.read(self.CHUNK_SIZE - len(chunk)))
 
             if len(chunk) < self.CHUNK_SIZE:
+                if self._digest_field and not self._digest_sent:
+                    # file is over, now we know the digest
+                    self.tail = self._generate_tail()
+                    self._digest_sent = True
+
                 c = str(self.tail[:self.CHUNK_SIZE - len(chunk)])
                 chunk += c
                 self.tail = self.tail[len(c):]
@@ -162,26 +181,7 @@ class MultiPartProducer():
     def _file_size(self, handle):
         """ Calculates file size """
 
-        if isinstance(handle, file):
-            handle.seek(0)
+        if hasattr(handle, 'fileno'):
             size = os.fstat(handle.fileno()).st_size
-            handle.seek(0)
-
-        # elif isinstance(handle, librsync.DeltaFile):
-        #     # TODO
-        #     # I don't like this way of calculating.
-        #     # there should be a more elegant one
-        #     size = 0
-        #     while True:
-        #         line = handle.read(4096)
-        #         if not line: break
-        #         size += len(line)
-
-        #     # DeltaFiles does not support seek,
-        #     # so basically with reset() I'm creating
-        #     # the file again. Since librsync patches
-        #     # on the fly (?) there is practically
-        #     # no overhead into recreating
-        #     handle.reset()
 
         return size
@@ -1,13 +1,35 @@
 # standard modules
-from collections import deque
+import json
+import time
+import bisect
 import logging
 log = logging.getLogger("melissilogger")
 
+# extra modules
+from twisted.internet import defer, reactor
+
 # melissi. modules
-from actions import GetUpdates, CreateDir, MoveDir
+import actions
+import dbschema as db
+
+class Lane(object):
+    """
+    A lane of the Queue, see WorkerAction.lane. Items are kept ordered
+    by deadline, the time they were queued plus their size divided by
+    Queue.SIZE_RATE, so that small items go first but a big item is
+    not starved by a stream of small ones queued after it. Lanes
+    without a `weight` are served before all others, in order.
+    """
+    def __init__(self, name, weight=None):
+        self.name = name
+        self.weight = weight
+        self.credit = 0
 
-if log.level <= logging.DEBUG:
-    from twisted.internet import reactor
+        # (deadline, sequence, item)
+        self.items = []
+
+    def __len__(self):
+        return len(self.items)
 
 class Queue(object):
     """ Simple Queue Service.
@@ -15,19 +37,66 @@ class Queue(object):
     Provides queues for actions to be executed asap, for actions
     waiting for other actions and for desktop notifications
 
+    Queued actions are placed in lanes, see WorkerAction.lane and
+    Lane. CreateDir and MoveDir go to the priority lane, which is
+    always served first so that parents are created before their
+    children. The other lanes take turns by smooth weighted round
+    robin, see ConfigManager.get_lane_weights: a lane with twice the
+    weight is served twice as often, and every lane with items is
+    served at least once every sum(weights) items, so none starves.
+    The order of actions is kept only inside a lane, thus cell and
+    droplet updates share the updates lane.
+
+    Persistent actions (see WorkerAction.persistent) are stored in
+    the queue table from the time they are queued until they finish,
+    including while they wait or retry, and are queued again by
+    restore() when we start. Changes are kept in a journal and
+    written by sync_journal(), see Worker.commit.
+
+    Waiting actions form a dependency graph: waiting_list maps the
+    keys actions wait for (see WaitItem) to the waiting actions, and
+    every action from the time it is queued until it is done provides
+    the keys of WorkerAction.provides. Waiting actions are queued
+    again when an action providing their key succeeds, see wake_up,
+    or when the last one is done without success. An action is not
+    put in the waiting list if nothing provides its key, or if it
+    would wait for itself, see put_into_waiting_list.
+
+    An idle Worker waits for items with wait(), instead of polling.
+
     """
+    PRIORITY_LANE = 'priority'
+    DEFAULT_LANE = 'metadata'
+
+    # bytes per second to turn the size of an item into a delay of
+    # its deadline, see Lane
+    SIZE_RATE = 2**20
 
     def __init__(self, hub):
-        self.priority_queue = deque()
-        self.queue = deque()
+        self._hub = hub
+        self._lanes = [Lane(self.PRIORITY_LANE)]
+        weights = hub.config_manager.get_lane_weights()
+        for name in sorted(weights, key=weights.get, reverse=True):
+            self._lanes.append(Lane(name, weights[name]))
+        self.lanes = dict((lane.name, lane) for lane in self._lanes)
+
+        self._sequence = 0
+        self._last_time = 0
+        self._index = {}
         self._notifications = []
         self.waiting_list = {}
-        self._hub = hub
+        self._providers = {}
+        self._provided = {}
+        self._journal = []
+        self._waiters = []
 
-        if __debug__:
+        # only when logged, an idle client keeps no timers
+        if log.isEnabledFor(5):
             def report():
-                log.log(5, "Queue size: %s queued, %s waiting" %\
-                        (len(self.queue) + len(self.priority_queue),
+                log.log(5, "Queue size: %s queued (%s), %s waiting" %\
+                        (len(self),
+                         ', '.join('%s %s' % (lane.name, len(lane))
+                                   for lane in self._lanes if lane.items),
                          len(self.waiting_list)
                          )
                         )
@@ -36,57 +105,280 @@ class Queue(object):
 
             reactor.callWhenRunning(report)
 
-    def get(self):
-        try:
-            return self.priority_queue.popleft()
-        except IndexError:
-            return self.queue.popleft()
+    def get(self, accept=None, lookahead=None):
+        """
+        Pop and return the first item of the lane whose turn it is.
+        If `accept` is given return the first item for which
+        accept(item) is True, looking at most `lookahead` items deep
+        in every lane, in the order of their turns. Raise IndexError
+        if no item is found.
+        """
+        for lane in self._lanes_by_turn():
+            for index, (_, _, item) in enumerate(lane.items):
+                if lookahead is not None and index >= lookahead:
+                    break
+
+                if accept is None or accept(item):
+                    del lane.items[index]
+                    self._unindex(item)
+                    self._charge(lane)
+                    return item
+
+        raise IndexError("No acceptable item in queue")
+
+    def _lanes_by_turn(self):
+        # the lane which would gain most credit is served first
+        lanes = [lane for lane in self._lanes if lane.items]
+        lanes.sort(key=lambda lane: (lane.weight is not None,
+                                     -(lane.credit + (lane.weight or 0))))
+        return lanes
+
+    def _charge(self, served):
+        # smooth weighted round robin: every lane with items gains its
+        # weight, the served lane pays the weights of all of them
+        if served.weight is None:
+            return
+
+        active = [lane for lane in self._lanes
+                  if lane.weight is not None and (lane.items or lane is served)]
+        for lane in active:
+            lane.credit += lane.weight
+        served.credit -= sum(lane.weight for lane in active)
+
+        # idle lanes don't save credit
+        for lane in self._lanes:
+            if not lane.items:
+                lane.credit = 0
 
     def put(self, item):
-        if item in self.priority_queue or item in self.queue:
+        # self._index holds the last queued item for every queue_key,
+        # so that duplicates are found without scanning the queues.
+        # GetUpdates have a constant key, thus only one is queued
+        key = item.queue_key
+        queued = self._index.get(key)
+        if queued is item:
             log.debug("Dropping item already in queue")
             return
 
-        if isinstance(item, CreateDir) or \
-           isinstance(item, MoveDir):
-            # place in the top of the queue
-            self.priority_queue.append(item)
+        if queued is not None and queued.coalesce(item):
+            log.debug("Coalescing %s with queued item" % item.action_name)
+
+            # a retried or woken up item is dropped as if it finished,
+            # the queued one provides what it did
+            if item in self._provided or item.journal_id is not None:
+                self.done(item)
+            return
 
-        else:
-            # allow only one GetUpdates into queue
-            if isinstance(item, GetUpdates):
-                for i in self.queue:
-                    if isinstance(i, GetUpdates):
-                        log.debug("Dropping duplicate GetUpdates")
-                        return
+        self._index[key] = item
+        self._journal_save(item)
+        self._provide(item)
 
-            self.queue.append(item)
+        lane = self.lanes.get(item.lane, self.lanes[self.DEFAULT_LANE])
+
+        # the clock may go back, but items of a lane stay in order
+        self._last_time = max(self._last_time, time.time())
+        deadline = self._last_time
+        if lane.weight is not None:
+            deadline += float(item.size) / self.SIZE_RATE
+
+        self._sequence += 1
+        bisect.insort(lane.items, (deadline, self._sequence, item))
+
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            waiter.callback(self)
+
+    def wait(self):
+        """ Return a deferred fired the next time an item is queued """
+        waiter = defer.Deferred()
+        self._waiters.append(waiter)
+        return waiter
+
+    def _unindex(self, item):
+        key = item.queue_key
+        if self._index.get(key) is item:
+            del self._index[key]
 
     def clear_all(self):
-        self.priority_queue = deque()
-        self.queue = deque()
+        for lane in self._lanes:
+            lane.items = []
+            lane.credit = 0
+        self._index = {}
         self._notifications = []
         self.waiting_list = {}
+        self._providers = {}
+        self._provided = {}
+
+        self._journal = []
+        self._hub.database_manager.store.find(db.QueueEntry).remove()
+
+    def __len__(self):
+        return sum(len(lane) for lane in self._lanes)
 
     def __contains__(self, item):
-        if item in self.queue or item in self.priority_queue:
-            return True
-        else:
-            return False
+        return item.queue_key in self._index
+
+    def _provide(self, item):
+        if item in self._provided:
+            return
+
+        keys = tuple(item.provides)
+        self._provided[item] = keys
+        for key in keys:
+            self._providers.setdefault(key, set()).add(item)
+
+    def _depends_on(self, key, item, seen):
+        # True if a provider of `key` is `item`, or waits for a key
+        # that depends on `item`
+        for provider in self._providers.get(key, ()):
+            if provider is item:
+                return True
+
+            waiting_id = provider.waiting_id
+            if waiting_id is not None and waiting_id not in seen:
+                seen.add(waiting_id)
+                if self._depends_on(waiting_id, item, seen):
+                    return True
+
+        return False
 
     def put_into_waiting_list(self, waiting_id, item):
+        """
+        Put `item` in the waiting list of key `waiting_id`. Return
+        False if no other action provides the key, or if waiting would
+        be a cycle
+        """
+        self._provide(item)
+
+        if waiting_id not in self._providers:
+            log.debug("Nothing provides %s %s for %s" %\
+                      (waiting_id[0], waiting_id[1], item.action_name))
+            return False
+
+        if self._depends_on(waiting_id, item, set([waiting_id])):
+            log.debug("%s would wait for itself" % item.action_name)
+            return False
+
+        item.waiting_id = waiting_id
+        self._journal_save(item)
+
         try:
             self.waiting_list[waiting_id].append(item)
         except KeyError:
             self.waiting_list[waiting_id] = [item]
 
+        return True
+
     def wake_up(self, waiting_id):
         if waiting_id in self.waiting_list:
-            for item in self.waiting_list[waiting_id]:
+            for item in self.waiting_list.pop(waiting_id):
                 log.log(5, "Waking up %s" % item)
+                item.waiting_id = None
+                self.put(item)
+
+    def done(self, item):
+        """
+        Remove `item`, which finished or was dropped, from the queue
+        table and the providers. Actions waiting for keys nothing
+        provides anymore are queued again
+        """
+        if item.persistent:
+            self._journal.append(('done', item))
+
+        for key in self._provided.pop(item, ()):
+            providers = self._providers[key]
+            providers.discard(item)
+            if not providers:
+                del self._providers[key]
+                self.wake_up(key)
+
+    def _journal_save(self, item):
+        if item.persistent:
+            self._journal.append(('save', item))
+
+    def sync_journal(self):
+        """
+        Write the changes of the queue since the last call to the
+        queue table. The Worker calls me before every savepoint and
+        commit, so that the queue table is committed together with
+        the database changes of the finished actions, and a failing
+        action does not roll back the changes of the queue
+        """
+        if not self._journal:
+            return
+
+        store = self._hub.database_manager.store
+        journal, self._journal = self._journal, []
+        for operation, item in journal:
+            entries = store.find(db.QueueEntry,
+                                 db.QueueEntry.id == item.journal_id)
+
+            if operation == 'done':
+                if item.journal_id is not None:
+                    entries.remove()
+                    item.journal_id = None
+
+            elif item.journal_id is not None:
+                entries.set(waiting_id=unicode(json.dumps(item.waiting_id)),
+                            attempts=item.attempts)
+
+            else:
+                try:
+                    arguments = json.dumps(item.arguments)
+                except (TypeError, ValueError), e:
+                    log.warning("Cannot store %s in queue table: %s" %\
+                                (item.action_name, e))
+                    continue
+
+                entry = db.QueueEntry()
+                entry.action = unicode(item.__class__.__name__)
+                entry.arguments = unicode(arguments)
+                entry.waiting_id = unicode(json.dumps(item.waiting_id))
+                entry.attempts = item.attempts
+                store.add(entry)
+                store.flush()
+                item.journal_id = entry.id
+
+    def restore(self):
+        """
+        Queue again the actions of the queue table, the ones not
+        finished when we stopped. Waiting actions go to the waiting
+        list
+        """
+        store = self._hub.database_manager.store
+        entries = store.find(db.QueueEntry).order_by(db.QueueEntry.id)
+
+        restored = 0
+        waiting = []
+        for entry in entries:
+            try:
+                cls = getattr(actions, entry.action)
+                args, kwargs = json.loads(entry.arguments)
+                kwargs = dict((str(key), value) for key, value in kwargs.items())
+                item = cls(self._hub, *args, **kwargs)
+                waiting_id = json.loads(entry.waiting_id)
+            except Exception, e:
+                log.warning("Dropping stored %s: %s" % (entry.action, e))
+                store.remove(entry)
+                continue
+
+            item.journal_id = entry.id
+            item.attempts = entry.attempts or 0
+            if waiting_id is None:
+                self.put(item)
+            else:
+                # JSON turned the key into a list
+                waiting.append((tuple(waiting_id), item))
+                self._provide(item)
+            restored += 1
+
+        # wait after all providers are known
+        for waiting_id, item in waiting:
+            if not self.put_into_waiting_list(waiting_id, item):
                 self.put(item)
 
-            del(self.waiting_list[waiting_id])
+        self._hub.database_manager.commit()
+        log.info("Restored %s queued actions" % restored)
 
     def put_into_notification_list(self, name, filepath, dirpath, owner, verb):
         """ owner is a dictionary with username, email, name """
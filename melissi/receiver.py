@@ -2,18 +2,40 @@
 # heavily modified for melissi
 
 # standard modules
+import os
 import tempfile
 
 # extra modules
 from twisted.internet import protocol
 from twisted.web import client
 
+# melissi modules
+import util
+
 class APIResponse(object):
-    """ An API Response object. """
-    def __init__(self):
-        self._content = tempfile.NamedTemporaryFile(prefix='melissi-',
-                                                    suffix='.tmp')
+    """
+    An API Response object.
+
+    If `destination`, a directory, is given the content is written to
+    a temporary file in it, which is kept after closing, so that it
+    can be renamed into place. The SHA-256 of the content is then
+    calculated while it is received, see hexdigest(). `signature` is
+    a function returning a delta.SignatureBuilder (or None) for the
+    expected content length, fed with the content too.
+    """
+    def __init__(self, destination=None, signature=None):
+        self._destination = destination
+        self._signature_function = signature
+        self._content = None
+        self._writer = None
         self._code = -1
+        self.signature = None
+        self.length = 0
+
+        if not destination:
+            self._content = tempfile.NamedTemporaryFile(prefix='melissi-',
+                                                        suffix='.tmp')
+            self._writer = self._content
 
     @property
     def code(self):
@@ -21,31 +43,67 @@ class APIResponse(object):
 
     @property
     def content(self):
+        if not self._content:
+            self.open()
         return self._content
 
     def __unicode__(self):
-        self._content.seek(0)
+        self.content.seek(0)
         return "Response code: %s\n%s" % (self.code, self._content.read())
 
     def set_code(self, code):
         self._code = code
 
+    def set_length(self, length):
+        if isinstance(length, (int, long)):
+            self.length = length
+
+    def open(self):
+        """ Create the temporary file in destination """
+        if self._signature_function:
+            self.signature = self._signature_function(self.length)
+
+        self._content = tempfile.NamedTemporaryFile(dir=self._destination,
+                                                    prefix=util.TEMP_PREFIX,
+                                                    suffix='.tmp',
+                                                    delete=False)
+        self._writer = util.HashingFile(self._content, self.signature)
+
+    def write(self, data):
+        if not self._writer:
+            self.open()
+        self._writer.write(data)
+
+    def hexdigest(self):
+        """ Return the SHA-256 of the content written to destination """
+        if not self._writer:
+            self.open()
+        return self._writer.hexdigest()
+
+    def discard(self):
+        """ Close and remove the temporary file in destination """
+        if self._destination and self._content:
+            self._content.close()
+            try:
+                os.unlink(self._content.name)
+            except OSError:
+                pass
+
 class StringReceiver(protocol.Protocol):
     """ String receiver protocol. To be used in combination
     with producer to upload files in a twisted python way
 
     """
-    def __init__(self, deferred=None):
+    def __init__(self, deferred=None, destination=None, signature=None):
         self._deferred = deferred
-        self.response = APIResponse()
+        self.response = APIResponse(destination, signature)
 
     def dataReceived(self, data):
-        """ Receives data. We don't expect a lot of data here
-        so we store result directly into memory
-        """
-        self.response.content.write(data)
+        """ Receives data into a temporary file, see APIResponse """
+        self.response.write(data)
 
     def connectionLost(self, reason):
+        self.response.content.flush()
         self.response.content.seek(0)
 
         if self.response.code >= 200 and self.response.code < 300:
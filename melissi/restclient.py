@@ -1,6 +1,7 @@
 # standard modules
 import urllib
 import json
+import random
 import base64
 import logging
 log = logging.getLogger("melissilogger")
@@ -9,22 +10,82 @@ log = logging.getLogger("melissilogger")
 from twisted.internet import reactor
 from twisted.web import client
 from twisted.web import http_headers
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, CancelledError
+from twisted.python.failure import Failure
 import twisted.internet.error
 import twisted.web.error
 
 # melissi modules
 import producer
 import receiver
+import util
 from actions import *
 
 class AuthenticationFailed(Exception):
     pass
 
+class ConnectionPool(client.HTTPConnectionPool):
+    """
+    A persistent HTTPConnectionPool which counts how many requests
+    opened a new connection and how many reused a cached one
+    """
+    def __init__(self, reactor, max_per_host, idle_timeout):
+        client.HTTPConnectionPool.__init__(self, reactor, persistent=True)
+        self.maxPersistentPerHost = max_per_host
+        self.cachedConnectionTimeout = idle_timeout
+        self.requests = 0
+        self.new_connections = 0
+
+    @property
+    def reused_connections(self):
+        return self.requests - self.new_connections
+
+    def getConnection(self, key, endpoint):
+        self.requests += 1
+        return client.HTTPConnectionPool.getConnection(self, key, endpoint)
+
+    def _newConnection(self, key, endpoint):
+        self.new_connections += 1
+        log.log(5, "New connection, %s new, %s reused so far" %\
+                (self.new_connections, self.reused_connections))
+        return client.HTTPConnectionPool._newConnection(self, key, endpoint)
+
 class RestClient():
+    # seconds to wait for more requests before sending a batch
+    BATCH_WINDOW = 0.05
+
+    # replies meaning that the server does not support long polling
+    NO_LONG_POLL_CODES = (404, 405, 501)
+
+    # seconds to wait for a long poll reply after the server's timeout
+    LONG_POLL_MARGIN = 15
+
+    # fraction of the update interval added or removed at random, so
+    # that clients don't poll together
+    UPDATE_JITTER = 0.2
+
     def __init__(self, hub):
         self.offline = True
         self._hub = hub
+        self.pool = ConnectionPool(reactor,
+                                   self._hub.config_manager.get_connections_per_host(),
+                                   self._hub.config_manager.get_connection_idle_timeout())
+        self._agent = client.Agent(reactor, pool=self.pool)
+
+        # batching, see batch()
+        self.batch_supported = False
+        self.batch_size = self._hub.config_manager.get_batch_size()
+        self._batch = []
+        self._batch_call = None
+
+        # long polling, see wait_for_updates()
+        self.long_poll_supported = False
+        self._waiting_for_updates = False
+
+        # polling at intervals, see poll_updates()
+        self.update_interval = self._hub.config_manager.get_update_interval()
+        self._poll_call = None
+
         self.connect()
 
     def online(self):
@@ -41,11 +102,139 @@ class RestClient():
             self.offline = False
             self._hub.desktop_tray.set_icon_ok()
             self._hub.desktop_tray.set_disconnect_menu()
+            self.long_poll_supported = self._hub.config_manager.get_long_poll()
+            if self._poll_call and self._poll_call.active():
+                self._poll_call.cancel()
+            self.update_interval = self._hub.config_manager.get_update_interval()
             self._hub.queue.put(GetUpdates(self._hub))
+            self._check_batch_support()
             reactor.callLater(0, self._hub.worker.work)
         else:
             self.disconnect()
 
+    def _check_batch_support(self):
+        """
+        Ask the server if it accepts batches. A server that does
+        replies to GET /api/batch/ with {'reply': {'max_operations': N}}
+        """
+        def supported(result):
+            reply = json.load(result.content)['reply']
+            self.batch_supported = True
+            self.batch_size = min(self.batch_size,
+                                  reply.get('max_operations', self.batch_size))
+            log.debug("Server supports batches of %s operations" % self.batch_size)
+
+        def not_supported(failure):
+            self.batch_supported = False
+            log.debug("Server does not support batches")
+
+        self.batch_supported = False
+        if self.batch_size < 2:
+            return
+
+        d = self.get('%s/api/batch/' % self._hub.config_manager.get_server())
+        d.addCallbacks(supported, not_supported)
+
+    def wait_for_updates(self):
+        """
+        Hold a request open until the server has changes after our
+        timestamp, then queue a GetUpdates. Return False if the server
+        does not support long polling; the caller should poll at
+        intervals instead.
+
+        The server replies to GET /api/status/wait/<timestamp>/ with
+        {'reply': {'changes': true}} when there are changes, or
+        {'reply': {'changes': false}} after `timeout` seconds. Then we
+        ask again. A reply lost on the way is given up LONG_POLL_MARGIN
+        seconds later.
+        """
+        if not self.long_poll_supported:
+            return False
+
+        if self._waiting_for_updates:
+            return True
+        self._waiting_for_updates = True
+
+        uri = '%s/api/status/wait/%s/' % (self._hub.config_manager.get_server(),
+                                          self._hub.config_manager.get_timestamp())
+        arguments = {'timeout': self._hub.config_manager.get_long_poll_timeout()}
+
+        d = self.get(uri + util.urlencode(arguments))
+        timeout = reactor.callLater(arguments['timeout'] + self.LONG_POLL_MARGIN,
+                                    d.cancel)
+
+        def stop_timeout(result):
+            if timeout.active():
+                timeout.cancel()
+            return result
+
+        d.addBoth(stop_timeout)
+        d.addCallback(self._wait_for_updates_success)
+        d.addErrback(self._wait_for_updates_failure)
+        return True
+
+    def _wait_for_updates_success(self, result):
+        self._waiting_for_updates = False
+
+        reply = json.load(result.content).get('reply', {})
+        if 'changes' not in reply:
+            log.debug("Server does not support long polling")
+            self.long_poll_supported = False
+            self.poll_updates()
+
+        elif reply['changes']:
+            self._hub.queue.put(GetUpdates(self._hub))
+
+        else:
+            self.wait_for_updates()
+
+    def _wait_for_updates_failure(self, failure):
+        self._waiting_for_updates = False
+
+        if getattr(failure.value, 'code', None) in self.NO_LONG_POLL_CODES:
+            log.debug("Server does not support long polling")
+            self.long_poll_supported = False
+        else:
+            log.debug("Waiting for updates failed %s" % failure.value)
+
+        # try again with the next GetUpdates
+        self.poll_updates()
+
+    def poll_updates(self, changes=False):
+        """
+        Queue a GetUpdates after update_interval seconds, give or take
+        UPDATE_JITTER. The interval drops to the minimum,
+        ConfigManager.get_update_interval, after `changes` and doubles
+        up to get_update_interval_max while nothing changes
+        """
+        minimum = self._hub.config_manager.get_update_interval()
+        maximum = self._hub.config_manager.get_update_interval_max()
+        if changes:
+            self.update_interval = minimum
+        else:
+            self.update_interval = max(minimum,
+                                       min(self.update_interval * 2, maximum))
+
+        if self._poll_call and self._poll_call.active():
+            self._poll_call.cancel()
+
+        delay = self.update_interval * random.uniform(1 - self.UPDATE_JITTER,
+                                                      1 + self.UPDATE_JITTER)
+        self._poll_call = reactor.callLater(delay, self._hub.queue.put,
+                                            GetUpdates(self._hub))
+
+    def update_activity(self):
+        """
+        Something changed locally, others probably change things too,
+        so poll again soon
+        """
+        minimum = self._hub.config_manager.get_update_interval()
+        self.update_interval = minimum
+
+        if self._poll_call and self._poll_call.active() and \
+           self._poll_call.getTime() - reactor.seconds() > minimum:
+            self._poll_call.reset(minimum)
+
     def _check_connection(self):
         # TODO
         return self._hub.config_manager.configured
@@ -65,19 +254,110 @@ class RestClient():
         uri = '%s/api/user/' % self._hub.config_manager.get_server()
         return self._sendRequest('POST', uri, data, auth=False)
 
-    def get(self, uri, data={}, file_handle=None):
-        return self._sendRequest('GET', uri, data, file_handle=None)
+    def get(self, uri, data={}, file_handle=None, destination=None,
+            signature=None):
+        """
+        When `destination` is given the content is written straight
+        to a temporary file in that directory, see receiver.APIResponse
+        """
+        return self._sendRequest('GET', uri, data, file_handle=None,
+                                 destination=destination,
+                                 signature=signature)
 
-    def post(self, uri, data={}, file_handle=None):
-        return self._sendRequest('POST', uri, data, file_handle)
+    def post(self, uri, data={}, file_handle=None, digest_field=None):
+        return self._sendRequest('POST', uri, data, file_handle,
+                                 digest_field=digest_field)
 
-    def put(self, uri, data={}, file_handle=None):
-        return self._sendRequest('PUT', uri, data, file_handle)
+    def put(self, uri, data={}, file_handle=None, digest_field=None):
+        return self._sendRequest('PUT', uri, data, file_handle,
+                                 digest_field=digest_field)
 
     def delete(self, uri):
         return self._sendRequest('DELETE', uri)
 
-    def _sendRequest(self, method, uri, data={}, file_handle=None, auth=True):
+    def batch(self, method, uri, data={}):
+        """
+        Send a request without a file, grouped with other requests in
+        one POST to /api/batch/ when the server supports it. Return a
+        deferred firing with an APIResponse, just like _sendRequest.
+
+        Requests are collected for BATCH_WINDOW seconds or until
+        batch_size are waiting. The batch request contains the field
+        'operations', a json list of {method, uri, data}, and the
+        server replies with a list of {code, reply}, one per
+        operation, in the same order.
+        """
+        if not self.batch_supported:
+            return self._sendRequest(method, uri, data)
+
+        data = dict(data)
+        data['resource'] = self._hub.config_manager.config.get('main', 'resource')
+
+        d = Deferred()
+        self._batch.append(({'method': method, 'uri': uri, 'data': data}, d))
+
+        if len(self._batch) >= self.batch_size:
+            self._send_batch()
+        elif not (self._batch_call and self._batch_call.active()):
+            self._batch_call = reactor.callLater(self.BATCH_WINDOW,
+                                                 self._send_batch)
+        return d
+
+    def _send_batch(self):
+        if self._batch_call and self._batch_call.active():
+            self._batch_call.cancel()
+
+        batch = self._batch
+        self._batch = []
+        if not batch:
+            return
+
+        if len(batch) == 1:
+            # no need to wrap a single request
+            operation, d = batch[0]
+            request = self._sendRequest(operation['method'],
+                                        operation['uri'],
+                                        operation['data'])
+            request.chainDeferred(d)
+            return
+
+        log.log(5, "Sending batch of %s operations" % len(batch))
+
+        def success(result):
+            replies = json.load(result.content)['reply']
+            for (_, d), reply in zip(batch, replies):
+                try:
+                    response = receiver.APIResponse()
+                    response.set_code(reply['code'])
+                    json.dump({'reply': reply['reply']}, response.content)
+                    response.content.seek(0)
+                except (KeyError, TypeError), error:
+                    d.errback(ValueError("Invalid batch reply %r: %s" % (reply, error)))
+                    continue
+
+                if response.code >= 200 and response.code < 300:
+                    d.callback(response)
+                else:
+                    d.errback(response)
+
+            if len(replies) != len(batch):
+                raise ValueError("Batch of %s operations got %s replies" %\
+                                 (len(batch), len(replies)))
+
+        def failure(error):
+            # every operation must fire, or its action never finishes
+            for _, d in batch:
+                if not d.called:
+                    d.errback(error)
+
+        uri = '%s/api/batch/' % self._hub.config_manager.get_server()
+        data = {'operations': json.dumps([op for op, _ in batch])}
+        request = self._sendRequest('POST', uri, data)
+        request.addCallback(success)
+        request.addErrback(failure)
+
+    def _sendRequest(self, method, uri, data={}, file_handle=None, auth=True,
+                     digest_field=None, destination=None, signature=None):
         # code from http://marianoiglesias.com.ar/python/file-\
         # uploading-with-multi-part-encoding-using-twisted/
         def finished(bytes):
@@ -99,8 +379,14 @@ class RestClient():
             log.exception(result)
             return result
 
+        def cancel(deferred):
+            # abort the request, or the response if it has started
+            request.cancel()
+            if myReceiver.transport is not None:
+                myReceiver.transport.stopProducing()
+
         # receiver
-        receiverDeferred = Deferred()
+        receiverDeferred = Deferred(cancel)
         receiverDeferred.addCallback(responseDone)
         # receiverDeferred.addErrback(responseFail)
 
@@ -109,7 +395,9 @@ class RestClient():
         producerDeferred.addCallback(finished)
         producerDeferred.addErrback(failure)
 
-        myReceiver = receiver.StringReceiver(receiverDeferred)
+        myReceiver = receiver.StringReceiver(receiverDeferred,
+                                             destination,
+                                             signature)
         headers = http_headers.Headers()
         if auth:
             # add authorization headers
@@ -121,17 +409,18 @@ class RestClient():
         if data or file_handle:
             myProducer = producer.MultiPartProducer(data,
                                                     file_handle,
-                                                    producerDeferred)
+                                                    producerDeferred,
+                                                    digest_field)
             headers.addRawHeader('Content-Type',
                                  'multipart/form-data; boundary=%s' % myProducer.boundary)
         else:
             myProducer = None
 
-        agent = client.Agent(reactor)
-        request = agent.request(method, uri, headers, myProducer)
+        request = self._agent.request(method, uri, headers, myProducer)
 
         def request_ok(response):
             myReceiver.response.set_code(response.code)
+            myReceiver.response.set_length(response.length)
 
             # workaround when sending a DELETE it seems that
             # connectionLost is never called from some reason also
@@ -156,9 +445,19 @@ class RestClient():
 
     def _connection_failure(self, failure):
         """ This is a deferred failure """
+        # a request cancelled before the response fails with the
+        # cancellation wrapped, see _sendRequest
+        reasons = getattr(failure.value, 'reasons', None)
+        if reasons and all(reason.check(CancelledError) for reason in reasons):
+            failure = Failure(CancelledError())
+
         try:
             failure.raiseException()
 
+        except CancelledError:
+            # we gave up the request, e.g. a long poll
+            pass
+
         except (twisted.internet.error.ConnectionRefusedError,
                 twisted.internet.error.ConnectionClosed,
                 twisted.internet.error.ConnectionLost,
@@ -183,7 +482,7 @@ class RestClient():
             log.warning("SSL Error while connecting")
 
         except Exception, error:
-            print error
+            log.debug("Request failed: %s" % error)
 
         finally:
             return failure
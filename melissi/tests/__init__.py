@@ -0,0 +1,31 @@
+# standard modules
+import os
+
+# melissi modules
+from melissi import config
+from melissi import dbstorm
+
+class Tray(object):
+    """ A desktop tray which shows nothing """
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+class Hub(object):
+    """
+    A hub with a configuration in `directory` and an in memory
+    database. With `server`, a server.FakeServer listening, the
+    configuration points to it
+    """
+    def __init__(self, directory, server=None):
+        self.config_manager = None
+        self.config_manager = config.ConfigManager(self,
+                                                   os.path.join(directory, 'config'))
+        self.database_manager = dbstorm.DatabaseManager(self, 'sqlite:')
+        self.desktop_tray = Tray()
+        self.queue = None
+        self.worker = None
+        self.rest_client = None
+        self.notify_manager = None
+
+        if server:
+            self.config_manager.config.set('main', 'host', server.url)
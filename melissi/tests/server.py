@@ -0,0 +1,49 @@
+# A stand-in for the melissi server, listening on localhost
+
+# standard modules
+import json
+
+# extra modules
+from twisted.internet import reactor
+from twisted.web import resource, server
+
+class FakeServer(resource.Resource):
+    """
+    Serve the requests whose path starts with a prefix of `routes`
+    with the matching function(request), which returns the body or
+    server.NOT_DONE_YET. Other requests get a 404. The paths of the
+    requests are kept in `requests`.
+    """
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.routes = {}
+        self.requests = []
+        self.port = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.port.getHost().port
+
+    def listen(self):
+        self.port = reactor.listenTCP(0, server.Site(self),
+                                      interface='127.0.0.1')
+        return self
+
+    def stop(self):
+        return self.port.stopListening()
+
+    def render(self, request):
+        self.requests.append(request.path)
+        for prefix in sorted(self.routes, key=len, reverse=True):
+            if request.path.startswith(prefix):
+                return self.routes[prefix](request)
+
+        return reply(request, {'error': 'not found'}, 404)
+
+def reply(request, content, code=200):
+    """ Return `content` as the JSON body of the response to `request` """
+    request.setResponseCode(code)
+    request.setHeader('Content-Type', 'application/json')
+    return json.dumps(content)
@@ -0,0 +1,89 @@
+# standard modules
+import random
+from cStringIO import StringIO
+
+# extra modules
+from twisted.trial import unittest
+
+# melissi modules
+from melissi import delta
+
+BLOCK_SIZE = delta.MIN_BLOCK_SIZE
+
+def data(size, seed):
+    generator = random.Random(seed)
+    return ''.join(chr(generator.randrange(256)) for _ in xrange(size))
+
+class DeltaTest(unittest.TestCase):
+    def round_trip(self, old, new):
+        """ Patch `old` into `new`, return the length of the delta """
+        signature = delta.signature(StringIO(old), BLOCK_SIZE)
+        out = StringIO()
+        length = delta.delta(signature, StringIO(new), out)
+        self.assertEqual(length, len(out.getvalue()))
+
+        patched = StringIO()
+        delta.patch(StringIO(out.getvalue()), StringIO(old), patched)
+        self.assertEqual(patched.getvalue(), new)
+        return length
+
+    def test_signature(self):
+        old = data(BLOCK_SIZE * 3 + 100, 1)
+        signature = delta.signature(StringIO(old), BLOCK_SIZE)
+        self.assertEqual(signature['block_size'], BLOCK_SIZE)
+        # the partial block at the end is not matched
+        self.assertEqual(len(signature['blocks']), 3)
+
+    def test_same(self):
+        old = data(BLOCK_SIZE * 20, 1)
+        self.assertTrue(self.round_trip(old, old) < 100)
+
+    def test_insert(self):
+        old = data(BLOCK_SIZE * 20, 1)
+        new = old[:1000] + 'inserted' + old[1000:]
+        # only the first block is sent again
+        self.assertTrue(self.round_trip(old, new) < BLOCK_SIZE + 100)
+
+    def test_changes(self):
+        old = data(BLOCK_SIZE * 20, 1)
+        new = old[:5000] + data(300, 2) + old[9000:-10] + 'end'
+        self.round_trip(old, new)
+
+    def test_small_old_file(self):
+        # no full block to match
+        self.round_trip('small', data(BLOCK_SIZE * 2, 1))
+
+    def test_empty(self):
+        self.round_trip('', '')
+        self.round_trip(data(BLOCK_SIZE * 2, 1), '')
+
+    def test_too_different(self):
+        old = data(BLOCK_SIZE * 20, 1)
+        signature = delta.signature(StringIO(old), BLOCK_SIZE)
+        self.assertRaises(delta.TooDifferent, delta.delta, signature,
+                          StringIO(data(BLOCK_SIZE * 20, 2)), StringIO(),
+                          BLOCK_SIZE * 4)
+
+        # a few changes are fine
+        new = old[:5000] + data(300, 2) + old[5000:]
+        delta.delta(signature, StringIO(new), StringIO(), BLOCK_SIZE * 4)
+
+    def test_too_different_small_old_file(self):
+        signature = delta.signature(StringIO('small'), BLOCK_SIZE)
+        self.assertRaises(delta.TooDifferent, delta.delta, signature,
+                          StringIO(data(BLOCK_SIZE * 2, 1)), StringIO(),
+                          BLOCK_SIZE)
+
+    def test_block_size(self):
+        self.assertEqual(delta.block_size_for(0), delta.MIN_BLOCK_SIZE)
+        self.assertEqual(delta.block_size_for(2**40), delta.MAX_BLOCK_SIZE)
+        self.assertEqual(delta.block_size_for(2**26) % 1024, 0)
+
+    def test_invalid(self):
+        old = StringIO(data(BLOCK_SIZE * 2, 1))
+        for invalid in ('', 'XXXX\x00\x00\x08\x00',
+                        delta.MAGIC + '\x00\x00\x08\x00' + 'X',
+                        delta.MAGIC + '\x00\x00\x08\x00' + 'D\x00\x00\x00\x10abc',
+                        delta.MAGIC + '\x00\x00\x08\x00' + 'C\x00\x00\x00\x05\x00\x00\x00\x01'):
+            self.assertRaises(ValueError, delta.patch, StringIO(invalid),
+                              old, StringIO())
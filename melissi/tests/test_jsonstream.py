@@ -0,0 +1,78 @@
+# standard modules
+import json
+import random
+from StringIO import StringIO
+
+# extra modules
+from twisted.trial import unittest
+
+# melissi modules
+from melissi import jsonstream
+
+DOCUMENT = {'timestamp': 1.5e3,
+            'cursor': -0.25,
+            'cells': [{'id': 1, 'name': u'\u03b1 b', 'pid': None},
+                      {'id': -12, 'name': 'c', 'pid': 1, 'deleted': True},
+                      ],
+            'droplets': [],
+            'error': {'code': 0, 'message': 'ok'},
+            'numbers': [0, -0, 10, 1e-7, -3.25E+10, 123456789012],
+            }
+
+class IterParseTest(unittest.TestCase):
+    def parse(self, text, chunk_size, arrays=('cells', 'droplets', 'numbers')):
+        return list(jsonstream.iterparse(StringIO(text), arrays,
+                                         chunk_size=chunk_size))
+
+    def expected(self, document, arrays=('cells', 'droplets', 'numbers')):
+        members = []
+        def walk(obj):
+            for name, value in obj.items():
+                if isinstance(value, dict):
+                    walk(value)
+                elif isinstance(value, list) and name in arrays:
+                    members.extend((name, element) for element in value)
+                else:
+                    members.append((name, value))
+        walk(document)
+        return members
+
+    def assertParses(self, text, chunk_size):
+        self.assertEqual(sorted(self.parse(text, chunk_size)),
+                         sorted(self.expected(json.loads(text))))
+
+    def test_one_byte_chunks(self):
+        for indent in (None, 2):
+            self.assertParses(json.dumps(DOCUMENT, indent=indent), 1)
+
+    def test_split_numbers(self):
+        # a chunk boundary after every character of the number
+        for number in ('-0.25', '1.5e3', '-3.25E+10', '1e-7', '120', '0'):
+            text = '{"a": %s}' % number
+            for chunk_size in range(1, len(text) + 1):
+                self.assertEqual(self.parse(text, chunk_size),
+                                 [(u'a', json.loads(number))])
+
+    def test_values(self):
+        text = json.dumps(DOCUMENT)
+        for chunk_size in (1, 7, len(text)):
+            members = list(jsonstream.iterparse(StringIO(text), ('cells',),
+                                                ('error',), chunk_size))
+            self.assertIn((u'error', DOCUMENT['error']), members)
+            self.assertNotIn(u'message', [name for name, _ in members])
+
+    def test_number_at_end_of_array(self):
+        self.assertEqual(self.parse('{"numbers": [1.5,2.25]}', 1),
+                         [(u'numbers', 1.5), (u'numbers', 2.25)])
+
+    def test_random_chunks(self):
+        text = json.dumps(DOCUMENT)
+        for _ in range(50):
+            self.assertParses(text, random.randint(1, len(text)))
+
+    def test_truncated(self):
+        text = json.dumps(DOCUMENT)
+        self.assertRaises(ValueError, self.parse, text[:-10], 3)
+
+    def test_not_an_object(self):
+        self.assertRaises(ValueError, self.parse, '[1, 2]', 4)
@@ -0,0 +1,47 @@
+# standard modules
+import hashlib
+import shutil
+import tempfile
+from cStringIO import StringIO
+
+# extra modules
+from twisted.trial import unittest
+
+# melissi modules
+from melissi import delta
+from melissi import util
+from melissi.actions import *
+from melissi.tests import Hub
+from melissi.tests.test_delta import BLOCK_SIZE, data
+
+class MakeDeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.hub = Hub(self.directory)
+        self.patch(delta, 'MAX_ROLLED', BLOCK_SIZE * 4)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_delta(self, old, new):
+        item = ModifyFile(self.hub, u'f', self.directory)
+        builder = delta.SignatureBuilder(BLOCK_SIZE)
+        item._file_handler = util.HashingFile(StringIO(new), builder)
+        signature = delta.signature(StringIO(old), BLOCK_SIZE)
+        return item, builder, item._make_delta(signature)
+
+    def test_delta(self):
+        old = data(BLOCK_SIZE * 20, 1)
+        _, _, (delta_file, length) = self.make_delta(old, old + 'end')
+        self.assertEqual(len(delta_file.read()), length)
+
+    def test_too_different(self):
+        new = data(BLOCK_SIZE * 20, 2)
+        item, builder, result = self.make_delta(data(BLOCK_SIZE * 20, 1), new)
+        self.assertEqual(result, (None, None))
+
+        # the whole file is still hashed, for the revision
+        self.assertEqual(item._file_handler.hexdigest(),
+                         hashlib.sha256(new).hexdigest())
+        self.assertEqual(builder.signature(),
+                         delta.signature(StringIO(new), BLOCK_SIZE))
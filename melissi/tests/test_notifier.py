@@ -0,0 +1,144 @@
+# standard modules
+import os
+import shutil
+import tempfile
+
+# extra modules
+from twisted.internet import reactor, task
+from twisted.trial import unittest
+
+# melissi modules
+from melissi import notifier
+from melissi import queue
+from melissi import restclient
+from melissi import dbschema as db
+from melissi.actions import *
+from melissi.tests import Hub
+
+class NotifierTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.hub = Hub(self.directory)
+        self.hub.queue = queue.Queue(self.hub)
+        self.hub.rest_client = restclient.RestClient(self.hub)
+        self.watched = os.path.join(self.directory, 'watched')
+        os.mkdir(self.watched)
+
+        watchpath = db.WatchPath()
+        watchpath.path = self.watched.decode('utf-8')
+        self.hub.database_manager.store.add(watchpath)
+
+        # watches are added when the reactor runs
+        self.started = []
+        self.patch(reactor, 'callWhenRunning',
+                   lambda *args: self.started.append(args))
+
+    def tearDown(self):
+        manager = self.hub.notify_manager
+        if manager:
+            reactor.removeReader(manager._initify_reader)
+            manager._inotify_wm.close()
+        shutil.rmtree(self.directory)
+        return self.hub.rest_client.pool.closeCachedConnections()
+
+    def start(self):
+        """ Create the NotifyManager and add the watches """
+        manager = self.hub.notify_manager = notifier.NotifyManager(self.hub)
+        for call in self.started:
+            call[0](*call[1:])
+        return manager
+
+    def create(self, *names):
+        path = os.path.join(self.watched, *names)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write('data')
+
+    def files(self):
+        return sorted(os.path.relpath(os.path.join(root, name), self.watched)
+                      for root, _, files in os.walk(self.watched)
+                      for name in files)
+
+    def queued(self):
+        items = []
+        while len(self.hub.queue):
+            items.append(self.hub.queue.get())
+        return items
+
+class TemporaryFilesTest(NotifierTestCase):
+    def setUp(self):
+        NotifierTestCase.setUp(self)
+        self.hub.config_manager.config.set('main', 'quiet_period', '0')
+
+    def test_remove_at_start(self):
+        self.create('.melissi-abc.tmp')
+        self.create('d', '.melissi-def.tmp')
+        self.create('d', 'f')
+        self.create('.melissi-notes')
+        self.create('.hidden.tmp')
+
+        self.start()
+        self.assertEqual(self.files(), ['.hidden.tmp', '.melissi-notes', 'd/f'])
+        self.assertIn(u'd/f', [item.filename for item in self.queued()])
+
+    def test_keep_on_rescan(self):
+        # a download may be running
+        manager = self.start()
+        self.create('d', '.melissi-abc.tmp')
+        manager.rescan_directories()
+        self.assertEqual(self.files(), ['d/.melissi-abc.tmp'])
+
+class QuietPeriodTest(NotifierTestCase):
+    def setUp(self):
+        NotifierTestCase.setUp(self)
+        self.hub.config_manager.config.set('main', 'quiet_period', '1')
+        self.hub.config_manager.config.set('main', 'max_hold', '5')
+
+        self.clock = task.Clock()
+        self.patch(reactor, 'callLater', self.clock.callLater)
+        self.patch(reactor, 'seconds', self.clock.seconds)
+        self.manager = self.start()
+
+    def tearDown(self):
+        for call in self.clock.getDelayedCalls():
+            call.cancel()
+        return NotifierTestCase.tearDown(self)
+
+    def modify(self, name):
+        action = ModifyFile(self.hub, name, self.watched)
+        self.manager.add_to_queue(action, os.path.join(self.watched, name))
+        return action
+
+    def test_coalesce(self):
+        self.modify(u'f')
+        self.clock.advance(0.5)
+        self.modify(u'f')
+        last = self.modify(u'f')
+
+        self.clock.advance(0.9)
+        self.assertEqual(self.queued(), [])
+        self.clock.advance(0.1)
+        self.assertEqual(self.queued(), [last])
+
+    def test_flush_after_quiet_period(self):
+        f = self.modify(u'f')
+        self.clock.advance(0.5)
+        g = self.modify(u'g')
+
+        self.clock.advance(0.5)
+        self.assertEqual(self.queued(), [f])
+        self.clock.advance(0.5)
+        self.assertEqual(self.queued(), [g])
+        self.assertFalse(self.clock.getDelayedCalls())
+
+    def test_max_hold(self):
+        # a file which is never quiet
+        queued = []
+        for _ in xrange(14):
+            self.modify(u'f')
+            self.clock.advance(0.5)
+            queued.append(len(self.queued()))
+
+        self.assertEqual(queued, [0] * 9 + [1] + [0] * 4)
+
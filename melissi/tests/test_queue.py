@@ -0,0 +1,262 @@
+# standard modules
+import shutil
+import tempfile
+
+# extra modules
+from twisted.trial import unittest
+
+# melissi modules
+from melissi import dbschema as db
+from melissi import queue
+from melissi.actions import *
+from melissi.tests import Hub
+
+class QueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.hub = Hub(self.directory)
+        self.queue = self.hub.queue = queue.Queue(self.hub)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def stored(self):
+        """ Return the action names in the queue table """
+        self.queue.sync_journal()
+        return sorted(entry.action for entry in
+                      self.hub.database_manager.store.find(db.QueueEntry))
+
+    def take(self, item):
+        """ Get `item` from the queue, as the Worker does """
+        self.assertIdentical(self.queue.get(lambda other: other is item), item)
+
+class DependencyTest(QueueTestCase):
+    def test_wait_and_wake_up(self):
+        parent = CreateDir(self.hub, u'd', u'/w')
+        child = ModifyFile(self.hub, u'd/f', u'/w')
+        self.queue.put(parent)
+        self.queue.put(child)
+        self.take(parent)
+        self.take(child)
+
+        self.assertTrue(self.queue.put_into_waiting_list(path_key(u'/w/d'), child))
+        self.assertEqual(len(self.queue), 0)
+
+        # success releases the waiting actions
+        for key in parent.provides:
+            self.queue.wake_up(key)
+        self.queue.done(parent)
+        self.assertEqual(len(self.queue), 1)
+        self.assertEqual(self.queue.waiting_list, {})
+        self.assertIdentical(child.waiting_id, None)
+
+    def test_provider_done_without_success(self):
+        parent = CreateDir(self.hub, u'd', u'/w')
+        child = ModifyFile(self.hub, u'd/f', u'/w')
+        self.queue.put(parent)
+        self.queue.put(child)
+        self.take(parent)
+        self.take(child)
+        self.queue.put_into_waiting_list(path_key(u'/w/d/'), child)
+
+        self.queue.done(parent)
+        self.assertEqual(len(self.queue), 1)
+        self.assertEqual(self.queue.waiting_list, {})
+
+    def test_orphan(self):
+        child = ModifyFile(self.hub, u'd/f', u'/w')
+        self.queue.put(child)
+        self.take(child)
+
+        self.assertFalse(self.queue.put_into_waiting_list(path_key(u'/w/d'), child))
+        self.assertFalse(self.queue.put_into_waiting_list(cell_key(5), child))
+        self.assertEqual(self.queue.waiting_list, {})
+
+    def test_cycle(self):
+        first = CreateDir(self.hub, u'a', u'/w')
+        second = CreateDir(self.hub, u'b', u'/w')
+        self.queue.put(first)
+        self.queue.put(second)
+        self.take(first)
+        self.take(second)
+
+        # waiting for itself
+        self.assertFalse(self.queue.put_into_waiting_list(path_key(u'/w/a'), first))
+
+        self.assertTrue(self.queue.put_into_waiting_list(path_key(u'/w/b'), first))
+        self.assertFalse(self.queue.put_into_waiting_list(path_key(u'/w/a'), second))
+
+    def test_coalesced_retry(self):
+        # a retried CreateDir is put again while a newer one is queued
+        retried = CreateDir(self.hub, u'd', u'/w')
+        child = ModifyFile(self.hub, u'd/f', u'/w')
+        self.queue.put(retried)
+        self.queue.put(child)
+        self.take(retried)
+        self.take(child)
+        self.queue.put_into_waiting_list(path_key(u'/w/d'), child)
+
+        newer = CreateDir(self.hub, u'd', u'/w')
+        self.queue.put(newer)
+        self.queue.put(retried)
+        self.assertEqual(len(self.queue), 1)
+        self.assertEqual(self.stored(), [u'CreateDir', u'ModifyFile'])
+
+        # the newer one fails, nothing provides the directory anymore
+        self.take(newer)
+        self.queue.done(newer)
+        self.assertEqual(self.queue.waiting_list, {})
+        self.assertEqual(len(self.queue), 1)
+
+        self.take(child)
+        self.queue.done(child)
+        self.assertEqual(self.stored(), [])
+        self.assertEqual(self.queue._providers, {})
+
+class LaneTest(QueueTestCase):
+    def drain(self):
+        items = []
+        while len(self.queue):
+            items.append(self.queue.get())
+        return items
+
+    def cell(self, id, parent=None):
+        return CellUpdate(self.hub, id, u'cell', parent, 1, {},
+                          '2011-01-01 00:00:00', '2011-01-01 00:00:00', False)
+
+    def droplet(self, id, cell):
+        return DropletUpdate(self.hub, id, u'droplet', {'id': cell}, {},
+                             '2011-01-01 00:00:00', '2011-01-01 00:00:00',
+                             u'', None, False, 1)
+
+    def test_priority_first(self):
+        deletes = [DeleteFile(self.hub, u'f%s' % i, u'/w') for i in range(3)]
+        directory = CreateDir(self.hub, u'd', u'/w')
+        for item in deletes + [directory]:
+            self.queue.put(item)
+
+        self.assertIdentical(self.drain()[0], directory)
+
+    def test_weights(self):
+        # metadata weighs 8, maintenance 1
+        metadata = [DeleteFile(self.hub, u'f%s' % i, u'/w') for i in range(20)]
+        rescans = [RescanDirectories(self.hub, [u'/w/%s' % i]) for i in range(3)]
+        for item in metadata + rescans:
+            self.queue.put(item)
+
+        lanes = [item.lane for item in self.drain()]
+        self.assertEqual(lanes[:9].count('maintenance'), 1)
+        self.assertEqual(lanes[:18].count('maintenance'), 2)
+
+    def test_no_starvation(self):
+        weights = self.hub.config_manager.get_lane_weights()
+        rescan = RescanDirectories(self.hub)
+        self.queue.put(rescan)
+        for i in range(100):
+            self.queue.put(DeleteFile(self.hub, u'f%s' % i, u'/w'))
+
+        self.assertIn(rescan, self.drain()[:sum(weights.values())])
+
+    def test_smaller_first(self):
+        large = self.hub.config_manager.get_large_file_size()
+        for name, size in ((u'big', 8), (u'small', 1), (u'medium', 4)):
+            item = ModifyFile(self.hub, name, u'/w')
+            item._size = size * large
+            self.queue.put(item)
+
+        self.assertEqual([item.filename for item in self.drain()],
+                         [u'small', u'medium', u'big'])
+
+    def test_updates_in_order(self):
+        # the order of GetUpdates._queue_updates, parents first
+        updates = [self.cell(1), self.cell(2, 1), self.droplet(10, 2),
+                   self.cell(3, 2), self.droplet(11, 3), self.droplet(12, 3)]
+        uploads = [DeleteFile(self.hub, u'f%s' % i, u'/w') for i in range(10)]
+        for update, upload in zip(updates, uploads):
+            self.queue.put(upload)
+            self.queue.put(update)
+
+        self.assertEqual([item for item in self.drain() if item in updates],
+                         updates)
+
+class RestoreTest(QueueTestCase):
+    def restart(self):
+        """ Return a new queue restored from the queue table """
+        self.queue.sync_journal()
+        self.queue = self.hub.queue = queue.Queue(self.hub)
+        self.queue.restore()
+        return self.queue
+
+    def test_restore(self):
+        directory = CreateDir(self.hub, u'd', u'/w')
+        modify = ModifyFile(self.hub, u'f', u'/w')
+        modify.attempts = 3
+        self.queue.put(directory)
+        self.queue.put(modify)
+        self.queue.put(GetUpdates(self.hub))
+        self.queue.sync_journal()
+        journal_ids = sorted([directory.journal_id, modify.journal_id])
+
+        restored = self.restart()
+        items = [restored.get(), restored.get()]
+        self.assertEqual(len(restored), 0)
+        self.assertEqual([item.__class__ for item in items], [CreateDir, ModifyFile])
+        self.assertEqual([(item.filename, item.watchpath) for item in items],
+                         [(u'd', u'/w'), (u'f', u'/w')])
+        self.assertEqual(items[1].attempts, 3)
+        self.assertEqual(sorted(item.journal_id for item in items), journal_ids)
+
+        # finished actions leave the table
+        for item in items:
+            restored.done(item)
+        self.assertEqual(self.stored(), [])
+
+    def test_restore_waiting(self):
+        parent = CreateDir(self.hub, u'd', u'/w')
+        child = ModifyFile(self.hub, u'd/f', u'/w')
+        self.queue.put(child)
+        self.queue.put(parent)
+        self.take(child)
+        self.take(parent)
+        self.queue.put_into_waiting_list(path_key(u'/w/d'), child)
+        self.queue.put(parent)
+
+        restored = self.restart()
+        self.assertEqual(len(restored), 1)
+        self.assertEqual(restored.waiting_list.keys(), [path_key(u'/w/d')])
+
+        # the restored parent wakes up the restored child
+        parent = restored.get()
+        for key in parent.provides:
+            restored.wake_up(key)
+        restored.done(parent)
+        self.assertEqual(restored.get().filename, u'd/f')
+
+    def test_restore_orphan(self):
+        # the provider finished but the child was not woken up
+        parent = CreateDir(self.hub, u'd', u'/w')
+        child = ModifyFile(self.hub, u'd/f', u'/w')
+        self.queue.put(parent)
+        self.queue.put(child)
+        self.take(parent)
+        self.take(child)
+        self.queue.put_into_waiting_list(path_key(u'/w/d'), child)
+        self.queue.sync_journal()
+        self.queue._journal.append(('done', parent))
+
+        restored = self.restart()
+        self.assertEqual(restored.waiting_list, {})
+        self.assertEqual(restored.get().filename, u'd/f')
+
+    def test_invalid_entry(self):
+        entry = db.QueueEntry()
+        entry.action = u'NoSuchAction'
+        entry.arguments = u'[[], {}]'
+        entry.waiting_id = u'null'
+        entry.attempts = 0
+        self.hub.database_manager.store.add(entry)
+        self.queue.put(DeleteFile(self.hub, u'f', u'/w'))
+
+        restored = self.restart()
+        self.assertEqual(len(restored), 1)
+        self.assertEqual(self.stored(), [u'DeleteFile'])
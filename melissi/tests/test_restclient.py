@@ -0,0 +1,135 @@
+# standard modules
+import json
+import shutil
+import tempfile
+
+# extra modules
+from twisted.internet import defer
+from twisted.trial import unittest
+from twisted.web import server
+
+# melissi modules
+from melissi import queue
+from melissi import restclient
+from melissi.tests import Hub
+from melissi.tests.server import FakeServer, reply
+
+class RestClientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = FakeServer().listen()
+        self.hub = Hub(self.directory, self.server)
+        self.client = self.hub.rest_client = restclient.RestClient(self.hub)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.client.pool.closeCachedConnections()
+        yield self.server.stop()
+        shutil.rmtree(self.directory)
+
+class BatchTest(RestClientTestCase):
+    def setUp(self):
+        RestClientTestCase.setUp(self)
+        self.client.batch_supported = True
+        self.server.routes['/api/batch/'] = self._batch
+        self.replies = None
+
+    def _batch(self, request):
+        operations = json.loads(request.args['operations'][0])
+        if self.replies is None:
+            replies = [{'code': 200, 'reply': operation['uri']}
+                       for operation in operations]
+        else:
+            replies = self.replies(operations)
+        return reply(request, {'reply': replies})
+
+    def send(self, count):
+        """ Send a batch of `count` operations, return their results """
+        deferreds = [self.client.batch('POST', '/api/cell/%s/' % number)
+                     for number in range(count)]
+        self.client._send_batch()
+        return defer.DeferredList(deferreds, consumeErrors=True)
+
+    @defer.inlineCallbacks
+    def test_batch(self):
+        results = yield self.send(3)
+        self.assertEqual([json.load(response.content)['reply']
+                          for _, response in results],
+                         ['/api/cell/0/', '/api/cell/1/', '/api/cell/2/'])
+        self.assertEqual(self.server.requests, ['/api/batch/'])
+
+    @defer.inlineCallbacks
+    def test_error_code(self):
+        self.replies = lambda operations: [{'code': 200, 'reply': {}},
+                                           {'code': 404, 'reply': {}}]
+        results = yield self.send(2)
+        self.assertEqual([ok for ok, _ in results], [True, False])
+        self.assertEqual(results[1][1].value.code, 404)
+
+    @defer.inlineCallbacks
+    def test_missing_reply(self):
+        self.replies = lambda operations: [{'code': 200},
+                                           {'code': 200, 'reply': {}}]
+        results = yield self.send(2)
+        self.assertEqual([ok for ok, _ in results], [False, True])
+        results[0][1].trap(ValueError)
+
+    @defer.inlineCallbacks
+    def test_fewer_replies(self):
+        self.replies = lambda operations: [{'code': 200, 'reply': {}}]
+        results = yield self.send(3)
+        self.assertEqual([ok for ok, _ in results], [True, False, False])
+
+    @defer.inlineCallbacks
+    def test_invalid_reply(self):
+        self.server.routes['/api/batch/'] = lambda request: 'not json'
+        results = yield self.send(2)
+        self.assertEqual([ok for ok, _ in results], [False, False])
+
+class LongPollTest(RestClientTestCase):
+    def setUp(self):
+        RestClientTestCase.setUp(self)
+        self.client.long_poll_supported = True
+        self.server.routes['/api/status/wait/'] = self._status_wait
+        self.answer = None
+        self.finished = None
+
+        # give up 0.1 seconds after the request
+        self.patch(self.hub.config_manager, 'get_long_poll_timeout', lambda: 0)
+        self.patch(self.client, 'LONG_POLL_MARGIN', 0.1)
+
+    def _status_wait(self, request):
+        self.finished = request.notifyFinish()
+        if self.answer is None:
+            return server.NOT_DONE_YET
+        return reply(request, {'reply': {'changes': self.answer}})
+
+    @defer.inlineCallbacks
+    def test_changes(self):
+        self.answer = True
+        self.hub.queue = queue.Queue(self.hub)
+        waiter = self.hub.queue.wait()
+
+        self.assertTrue(self.client.wait_for_updates())
+        yield waiter
+        self.assertIsInstance(self.hub.queue.get(), restclient.GetUpdates)
+        self.assertFalse(self.client._waiting_for_updates)
+
+    @defer.inlineCallbacks
+    def test_lost_reply(self):
+        polled = defer.Deferred()
+        self.patch(self.client, 'poll_updates', lambda: polled.callback(None))
+
+        failures = []
+        def failure(reason, original=self.client._wait_for_updates_failure):
+            failures.append(reason)
+            return original(reason)
+        self.patch(self.client, '_wait_for_updates_failure', failure)
+
+        self.assertTrue(self.client.wait_for_updates())
+        yield polled
+        self.assertFalse(self.client._waiting_for_updates)
+        failures[0].trap(defer.CancelledError)
+
+        # the request was aborted
+        yield self.assertFailure(self.finished, Exception)
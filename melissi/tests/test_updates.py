@@ -0,0 +1,262 @@
+# standard modules
+import os
+import hashlib
+import shutil
+import tempfile
+from cStringIO import StringIO
+
+# extra modules
+from twisted.internet import defer
+from twisted.trial import unittest
+
+# melissi modules
+from melissi import delta
+from melissi import util
+from melissi import dbschema as db
+from melissi import queue
+from melissi import restclient
+from melissi.actions import *
+from melissi.tests import Hub
+from melissi.tests.server import FakeServer, reply
+
+OLD = 'old content\n' * 1000
+NEW = 'old content\n' * 500 + 'new content\n' + 'old content\n' * 500
+
+class PatchTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = FakeServer().listen()
+        self.server.routes['/api/droplet/2/revision/latest/content/'] = \
+            lambda request: NEW
+        self.hub = Hub(self.directory, self.server)
+        self.hub.config_manager.config.set('main', 'delta_sync', 'True')
+        self.client = self.hub.rest_client = restclient.RestClient(self.hub)
+
+        # a file we have at revision 1
+        with open(os.path.join(self.directory, 'f'), 'wb') as f:
+            f.write(OLD)
+        watchpath = db.WatchPath()
+        watchpath.path = self.directory.decode('utf-8')
+        self.record = db.File()
+        self.record.id = 2
+        self.record.filename = u'f'
+        self.record.watchpath = watchpath
+        self.record.signature = delta.signature(StringIO(OLD),
+                                                delta.block_size_for(len(OLD)))
+        self.record.stat = util.get_stat(os.path.join(self.directory, 'f'))
+        self.hub.database_manager.store.add(self.record)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.client.pool.closeCachedConnections()
+        yield self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def update(self):
+        """ Return a DropletUpdate of the file to revision 2 """
+        item = DropletUpdate(self.hub, 2, u'f', {'id': 1}, {},
+                             '2011-01-01 00:00:00', '2011-01-01 00:00:00',
+                             unicode(hashlib.sha256(NEW).hexdigest()),
+                             None, False, 2)
+        item._record = self.record
+        return item
+
+    def content(self):
+        with open(os.path.join(self.directory, 'f'), 'rb') as f:
+            return f.read()
+
+    @defer.inlineCallbacks
+    def test_patch(self):
+        def patch(request):
+            out = StringIO()
+            delta.delta(self.record.signature, StringIO(NEW), out)
+            return out.getvalue()
+        self.server.routes['/api/droplet/2/revision/latest/patch/'] = patch
+
+        yield self.update()._get_patch()
+        self.assertEqual(self.content(), NEW)
+        self.assertEqual(self.record.revision, 2)
+        self.assertNotIn('/api/droplet/2/revision/latest/content/',
+                         self.server.requests)
+
+    @defer.inlineCallbacks
+    def test_no_patch(self):
+        # the server has no patch, the whole file is fetched
+        yield self.update()._get_patch()
+        self.assertEqual(self.content(), NEW)
+        self.assertEqual(self.record.revision, 2)
+        self.assertEqual(os.listdir(self.directory), ['config', 'f'])
+
+    @defer.inlineCallbacks
+    def test_invalid_patch(self):
+        self.server.routes['/api/droplet/2/revision/latest/patch/'] = \
+            lambda request: 'not a delta'
+
+        yield self.update()._get_patch()
+        self.assertEqual(self.content(), NEW)
+        self.assertEqual(self.server.requests[-1],
+                         '/api/droplet/2/revision/latest/content/')
+
+class MoveTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = FakeServer().listen()
+        self.server.routes['/api/droplet/2/revision/latest/content/'] = \
+            lambda request: NEW
+        self.hub = Hub(self.directory, self.server)
+        self.hub.queue = queue.Queue(self.hub)
+        self.client = self.hub.rest_client = restclient.RestClient(self.hub)
+        self.watched = os.path.join(self.directory, 'watched')
+
+        # file f of cell a, which moves to cell b
+        os.makedirs(os.path.join(self.watched, 'a'))
+        os.makedirs(os.path.join(self.watched, 'b'))
+        with open(os.path.join(self.watched, 'a', 'f'), 'wb') as f:
+            f.write(OLD)
+
+        store = self.hub.database_manager.store
+        watchpath = db.WatchPath()
+        watchpath.path = self.watched.decode('utf-8')
+        for id, filename in ((1, u'a'), (3, u'b')):
+            cell = db.File()
+            cell.id = id
+            cell.filename = filename
+            cell.directory = True
+            cell.watchpath = watchpath
+            store.add(cell)
+
+        self.record = db.File()
+        self.record.id = 2
+        self.record.filename = u'a/f'
+        self.record.parent_id = 1
+        self.record.hash = unicode(hashlib.sha256(OLD).hexdigest())
+        self.record.revision = 1
+        self.record.watchpath = watchpath
+        store.add(self.record)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.client.pool.closeCachedConnections()
+        yield self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def update(self, content):
+        """ Return a DropletUpdate moving the file to cell b """
+        owner = {'first_name': u'', 'last_name': u'',
+                 'username': u'', 'email': u''}
+        return DropletUpdate(self.hub, 2, u'f', {'id': 3}, owner,
+                             '2011-01-01 00:00:00', '2011-01-01 00:00:00',
+                             unicode(hashlib.sha256(content).hexdigest()),
+                             None, False, 2)
+
+    def content(self, *names):
+        with open(os.path.join(self.watched, *names), 'rb') as f:
+            return f.read()
+
+    def test_locks(self):
+        exclusive, _ = self.update(OLD).locks
+        self.assertIn(os.path.join(self.watched, 'a', 'f'), exclusive)
+        self.assertIn(os.path.join(self.watched, 'b', 'f'), exclusive)
+
+    @defer.inlineCallbacks
+    def test_move(self):
+        yield self.update(OLD)()
+        self.assertEqual(self.content('b', 'f'), OLD)
+        self.assertFalse(os.path.exists(os.path.join(self.watched, 'a', 'f')))
+        self.assertEqual((self.record.filename, self.record.parent_id),
+                         (u'b/f', 3))
+
+    @defer.inlineCallbacks
+    def test_move_with_content(self):
+        yield self.update(NEW)()
+        self.assertEqual(self.content('b', 'f'), NEW)
+        self.assertEqual(os.listdir(os.path.join(self.watched, 'a')), [])
+        self.assertEqual((self.record.filename, self.record.revision),
+                         (u'b/f', 2))
+
+    @defer.inlineCallbacks
+    def test_failed_download(self):
+        # nothing moves until the content is here
+        del self.server.routes['/api/droplet/2/revision/latest/content/']
+        yield self.assertFailure(self.update(NEW)(), RetryLater)
+        self.assertEqual(self.content('a', 'f'), OLD)
+        self.assertEqual(os.listdir(os.path.join(self.watched, 'b')), [])
+        self.assertEqual(self.record.filename, u'a/f')
+
+def cell(id, pid):
+    return {'id': id, 'name': u'c%s' % id, 'pid': pid, 'revisions': 1,
+            'owner': {}, 'created': '2011-01-01 00:00:00',
+            'updated': '2011-01-01 00:00:00', 'deleted': False}
+
+def droplet(id, cell):
+    return {'id': id, 'name': u'd%s' % id, 'cell': {'id': cell},
+            'owner': {}, 'created': '2011-01-01 00:00:00',
+            'updated': '2011-01-01 00:00:00', 'content_sha256': u'',
+            'patch_sha256': None, 'deleted': False, 'revisions': 1}
+
+class GetUpdatesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = FakeServer().listen()
+        self.server.routes['/api/status/after/'] = self._status
+        self.hub = Hub(self.directory, self.server)
+        self.hub.queue = queue.Queue(self.hub)
+        self.client = self.hub.rest_client = restclient.RestClient(self.hub)
+
+        self.polled = []
+        self.patch(self.client, 'poll_updates',
+                   lambda changes=False: self.polled.append(changes))
+
+        # pages by cursor, and the length of the queue when asked
+        self.pages = {}
+        self.queued = []
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.client.pool.closeCachedConnections()
+        yield self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def _status(self, request):
+        cursor = request.args.get('cursor', [None])[0]
+        self.queued.append(len(self.hub.queue))
+        return reply(request, self.pages[cursor])
+
+    def drain(self):
+        items = []
+        while len(self.hub.queue):
+            items.append(self.hub.queue.get())
+        return items
+
+    @defer.inlineCallbacks
+    def test_pages(self):
+        self.pages[None] = {'reply': {'timestamp': 100.5,
+                                      'cells': [cell(2, 1), cell(1, None)],
+                                      'droplets': [droplet(10, 2)],
+                                      'cursor': 'b'}}
+        self.pages['b'] = {'reply': {'timestamp': 200,
+                                     'cells': [cell(3, 1)],
+                                     'droplets': [droplet(11, 3)]}}
+
+        yield GetUpdates(self.hub)()
+
+        # every page is queued, parents first, before the next one
+        self.assertEqual(self.queued, [0, 3])
+        self.assertEqual([(item.__class__, item.id) for item in self.drain()],
+                         [(CellUpdate, 1), (CellUpdate, 2), (DropletUpdate, 10),
+                          (CellUpdate, 3), (DropletUpdate, 11)])
+
+        # the timestamp of the first page
+        self.assertEqual(self.hub.config_manager.get_timestamp(), '100.5')
+        self.assertEqual(self.polled, [True])
+
+    @defer.inlineCallbacks
+    def test_error(self):
+        self.hub.config_manager.set_timestamp(50)
+        self.pages[None] = {'error': {'code': 500, 'message': 'failed'}}
+
+        yield GetUpdates(self.hub)()
+        self.assertEqual(len(self.hub.queue), 0)
+        self.assertEqual(self.hub.config_manager.get_timestamp(), '50')
+        # polled again from the failure
+        self.assertEqual(len(self.polled), 1)
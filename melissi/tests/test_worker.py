@@ -0,0 +1,46 @@
+# standard modules
+import shutil
+import tempfile
+
+# extra modules
+from twisted.python import failure
+from twisted.trial import unittest
+
+# melissi modules
+from melissi import dbschema as db
+from melissi import queue
+from melissi import restclient
+from melissi import worker
+from melissi.actions import *
+from melissi.tests import Hub
+
+class OrphanTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.hub = Hub(self.directory)
+        self.hub.config_manager.config.set('main', 'retry_attempts', '1')
+        self.hub.queue = queue.Queue(self.hub)
+        self.hub.rest_client = restclient.RestClient(self.hub)
+        self.hub.rest_client.offline = False
+        self.worker = self.hub.worker = worker.Worker(self.hub)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        return self.hub.rest_client.pool.closeCachedConnections()
+
+    def give_up(self, error):
+        """ Fail an item with `error`, return what is queued then """
+        item = ModifyFile(self.hub, u'd/f', u'/w')
+        result = self.worker._action_failure(failure.Failure(error), item)
+        self.assertNotIdentical(result, worker.KEEP)
+        self.assertEqual(self.hub.database_manager.store.find(db.DeadLetter).count(), 1)
+        return [self.hub.queue.get() for _ in range(len(self.hub.queue))]
+
+    def test_missing_cell(self):
+        [item] = self.give_up(WaitItem(id=5))
+        self.assertIsInstance(item, GetUpdates)
+        self.assertTrue(item.full)
+
+    def test_missing_directory(self):
+        [item] = self.give_up(WaitItem(path=u'/w/d'))
+        self.assertIsInstance(item, RescanDirectories)
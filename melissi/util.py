@@ -12,10 +12,17 @@ log = logging.getLogger("melissilogger")
 
 # extra modules
 from twisted.web import client
+from twisted.internet import defer, reactor, threads
+from twisted.python.threadpool import ThreadPool
 
 WORKER_RECALL = 0.1
+HASH_CHUNK_SIZE = 2**20
+# prefix of the temporary files we create in watched directories
+TEMP_PREFIX = '.melissi-'
 gravatars = {}
 
+_hash_pool = None
+
 def append_to_filename(filename, append):
     try:
         base, ext = filename.split(".", 1)
@@ -25,7 +32,16 @@ def append_to_filename(filename, append):
     base = base + " " + append
     return base + ext
 
-def get_hash(filename=None, f=None):
+def is_temporary(path):
+    """ Return True if `path` is one of our temporary files """
+    return os.path.basename(path).startswith(TEMP_PREFIX)
+
+def get_hash(filename=None, f=None, signature=None):
+    """
+    Return the SHA-256 of `filename` or file object `f`. If
+    `signature`, a delta.SignatureBuilder, is given feed it with the
+    file too
+    """
     if filename:
         try:
             f = open(filename, 'rb')
@@ -35,9 +51,12 @@ def get_hash(filename=None, f=None):
     if f:
         hash_function = hashlib.sha256()
         while True:
-            chunk = f.read(4096)
+            # hashlib releases the GIL for big chunks
+            chunk = f.read(HASH_CHUNK_SIZE)
             if chunk == '': break
             hash_function.update(chunk)
+            if signature:
+                signature.update(chunk)
 
         if filename:
             # we opened the file ourselves
@@ -53,58 +72,85 @@ def get_hash(filename=None, f=None):
         # TODO return error
         return 1
 
-# def get_signature(filename):
-#     try:
-#         f = open(filename, 'rb')
-#     except IOError:
-#         # TODO add exception if we cannot open the file
-#         if __debug__:
-#             dprint("Signature exception", exception=1)
-#         raise
-
-#     signature_file = librsync.SigFile(f)
-#     signature = signature_file.read()
-#     return signature
-
-# def get_delta(signature, filename):
-#     ''' Get a filename and generate a delta for that file
-#         Returns a file object with the delta '''
-#     try:
-#         f = open(filename, 'rb')
-#     except IOError:
-#         if __debug__:
-#             dprint("Exception", filename, exception=1)
-#         raise Exception("delta exception")
+def start_hash_pool(threads, chunk_size=None):
+    """
+    Start a pool of `threads` threads used by defer_hash, reading
+    files in chunks of `chunk_size` bytes
+    """
+    global _hash_pool, HASH_CHUNK_SIZE
 
-#     delta_file = librsync.DeltaFile(signature, f)
+    if chunk_size:
+        HASH_CHUNK_SIZE = chunk_size
 
-#     return delta_file
+    _hash_pool = ThreadPool(minthreads=0, maxthreads=threads,
+                            name='melissi-hash')
+    _hash_pool.start()
+    reactor.addSystemEventTrigger('during', 'shutdown', _hash_pool.stop)
 
-# def patch_file(delta, filename, hash=None):
-#     # TODO using stringio means that we store delta into memory!
-#     try:
-#         f = open(filename, 'rb')
-#     except IOError:
-#         if __debug__:
-#             dprint("Patch error, cannot open filename '%s'" % filename, exception=1)
-#         raise Exception("Patch exception")
-
-#     new_file = librsync.PatchedFile(f, delta)
-#     tmp_file = tempfile.TemporaryFile(prefix='melisi-', suffix='.patched')
-#     tmp_file.write(new_file.read())
-#     tmp_file.seek(0)
-#     if not hash or hash == get_hash(f=tmp_file):
-#         try:
-#             f = open(filename, 'wb')
-#             f.write(tmp_file.read())
-#             f.close()
-#         except IOError:
-#             raise Exception("Patch exception 2")
-#     else:
-#         if __debug__:
-#             dprint(get_hash(f=tmp_file), hash)
-#         raise Exception("Hashes don't match!")
+def defer_to_pool(function, *args, **kwargs):
+    """
+    Call function in a thread of the hash pool and return a
+    deferred, to keep the reactor responsive while reading big
+    files. Without a started pool call it right away
+    """
+    if not _hash_pool:
+        return defer.maybeDeferred(function, *args, **kwargs)
+
+    return threads.deferToThreadPool(reactor, _hash_pool,
+                                     function, *args, **kwargs)
+
+def defer_hash(filename=None, f=None, signature=None):
+    """ Same as get_hash, but in the hash pool, see defer_to_pool """
+    return defer_to_pool(get_hash, filename=filename, f=f,
+                         signature=signature)
+
+def get_stat(filename):
+    """
+    Return (size, mtime_ns, inode, ctime_ns) of `filename`. When the
+    stat of a file is the same as when we hashed it, we assume that the
+    file did not change
+    """
+    stat = os.stat(filename)
+    return (stat.st_size,
+            int(stat.st_mtime * 10**9),
+            stat.st_ino,
+            int(stat.st_ctime * 10**9)
+            )
+
+class HashingFile(object):
+    """
+    Wrap file object `f` and calculate the SHA-256 of the data read
+    or written through me, so that a file can be hashed while it is
+    uploaded. If `signature`, a delta.SignatureBuilder, is given feed
+    it with the data too
+    """
+    def __init__(self, f, signature=None):
+        self._file = f
+        self._hash_function = hashlib.sha256()
+        self._signature = signature
+
+    def _update(self, data):
+        self._hash_function.update(data)
+        if self._signature:
+            self._signature.update(data)
+
+    def read(self, size=-1):
+        chunk = self._file.read(size)
+        self._update(chunk)
+        return chunk
+
+    def write(self, data):
+        self._update(data)
+        self._file.write(data)
+
+    def hexdigest(self):
+        return unicode(self._hash_function.hexdigest())
+
+    def fileno(self):
+        return self._file.fileno()
 
+    def close(self):
+        self._file.close()
 
 def create_path(path):
     import os, errno
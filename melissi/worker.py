@@ -3,6 +3,8 @@
 #
 
 # stardard modules
+import random
+from datetime import datetime
 import logging
 log = logging.getLogger("melissilogger")
 
@@ -15,62 +17,206 @@ import util
 import dbschema as db
 from actions import *
 
+# returned by Worker._action_failure for items which wait or retry,
+# and thus stay in the queue table
+KEEP = object()
+
 class Worker(object):
+    """
+    I execute the actions found in the queue.
+
+    Up to `workers` actions (see ConfigManager.get_workers) run at the
+    same time. Actions that touch the same path or id, or a parent /
+    child of it, are never executed concurrently; see
+    WorkerAction.locks. Actions flagged as `exclusive` run alone.
+
+    When the server accepts batches, up to RestClient.batch_size
+    `batchable` actions run in addition, so that their requests are
+    sent together.
+
+    Finished actions are committed to the database in groups, every
+    `commit_items` actions or `commit_interval` seconds, see commit().
+    A failing action rolls back to the savepoint of the last finished
+    one.
+
+    Actions raising RetryLater are retried after an exponential,
+    randomized delay. After `retry_attempts` attempts they are stored
+    in the dead letter table instead. Attempts made while we are
+    offline don't count.
+
+    Actions raising WaitItem are put in the waiting list of the
+    Queue, or retried when no other action provides what they wait
+    for, see Queue.put_into_waiting_list. When those give up, a full
+    update or a rescan is queued to create what they waited for, and
+    them again, see _repair.
+
+    Items which wait or retry stay in the queue table; the others are
+    removed from it when they finish, with the same commit, see
+    Queue.sync_journal.
+
+    I don't poll: queued items wake me up, see Queue.wait, as well as
+    finishing items. While offline RestClient.connect does.
+
+    """
+    # how many queued items to inspect when looking for an item that
+    # does not conflict with the running ones
+    LOOKAHEAD = 64
+
     def __init__(self, hub):
         self._hub = hub
         self._dms = self._hub.database_manager.store
         self.processing = False
+        self.workers = self._hub.config_manager.get_workers()
+        self.running = {}
+        self._delayed_call = None
+        self._waiting = None
+
+        # group commit
+        self.commit_items = self._hub.config_manager.get_commit_items()
+        self.commit_interval = self._hub.config_manager.get_commit_interval()
+        self._uncommitted = 0
+        self._commit_call = None
+        reactor.addSystemEventTrigger('before', 'shutdown', self.commit)
+
+        # retries
+        self.retry_attempts = self._hub.config_manager.get_retry_attempts()
+        self.retry_max_delay = self._hub.config_manager.get_retry_max_delay()
+        self.retries = {}
+        self.dead_letters = {}
 
     def work(self):
         # TODO: find a better async way
         if self._hub.rest_client.offline:
             return
 
-        try:
-            item = self._hub.queue.get()
-        except IndexError:
-            if self.processing:
-                self.processing = False
-                self._hub.desktop_tray.set_icon_ok()
+        while self._has_slot(batched=False) or self._has_slot(batched=True):
+            try:
+                item = self._hub.queue.get(self._get_filter(),
+                                           lookahead=self.LOOKAHEAD)
+            except IndexError:
+                break
 
-                # notify
-                item = NotifyUser(hub=self._hub)
-                self.process_item(item)
+            self.processing = True
+            self._hub.desktop_tray.set_icon_update("Bbzzzz...")
+            self.process_item(item)
 
-            else:
-                reactor.callLater(1, self.work)
+        # a queued item wakes us up, as well as a finishing one
+        if self._waiting is None:
+            self._waiting = self._hub.queue.wait()
+            self._waiting.addCallback(self._wake_up)
 
+        if self.running or len(self._hub.queue):
             return
 
-        self.processing = True
-        self._hub.desktop_tray.set_icon_update("Bbzzzz...")
-        self.process_item(item)
+        if self._uncommitted:
+            self.commit()
+
+        if self.processing:
+            self.processing = False
+            self._hub.desktop_tray.set_icon_ok()
+
+            # notify
+            item = NotifyUser(hub=self._hub)
+            self.process_item(item)
+
+    def _wake_up(self, queue):
+        self._waiting = None
+        self._schedule()
+
+    def _schedule(self):
+        if self._delayed_call and self._delayed_call.active():
+            self._delayed_call.cancel()
+
+        self._delayed_call = reactor.callLater(0, self.work)
+
+    def _batched(self, item):
+        return item.batchable and self._hub.rest_client.batch_supported
+
+    def _has_slot(self, batched):
+        if batched:
+            if not self._hub.rest_client.batch_supported:
+                return False
+            slots = self._hub.rest_client.batch_size
+        else:
+            slots = self.workers
+
+        running = len([item for item in self.running
+                       if self._batched(item) == batched])
+        return running < slots
+
+    def _get_filter(self):
+        """
+        Return a function which accepts a queued item if it does not
+        conflict with a running item, or with an item skipped before
+        it. The latter keeps the order of actions on the same
+        resource.
+        """
+        held = self.running.values()
+
+        def accept(item):
+            locks = None if item.exclusive else item.locks
+            ok = self._has_slot(self._batched(item)) and \
+                 self._compatible(locks, held)
+            held.append(locks)
+            return ok
+
+        return accept
+
+    def _compatible(self, locks, held):
+        if not held:
+            return True
+
+        if locks is None:
+            return False
+
+        exclusive, shared = locks
+        for other in held:
+            if other is None:
+                return False
+
+            other_exclusive, other_shared = other
+            if exclusive & other_exclusive or \
+               exclusive & other_shared or \
+               shared & other_exclusive:
+                return False
+
+        return True
 
     def process_item(self, item):
         # notify tray and stdout
         log.info("Worker processing %s" % item.action_name)
 
+        self.running[item] = None if item.exclusive else item.locks
+
         d = defer.maybeDeferred(item)
         d.addErrback(self._action_failure, item)
-        d.addBoth(self._call_worker)
+        d.addBoth(self._call_worker, item)
 
     def _action_failure(self, failure, item):
         # rollback database
         log.info("Rolling back [%s]" % item)
 
-        self._hub.database_manager.rollback()
+        self._hub.database_manager.rollback_to_savepoint()
 
         try:
             failure.raiseException()
 
         except WaitItem, e:
-            log.debug("Item %s waits for %s" % (item.id, e.id))
-            self._hub.queue.put_into_waiting_list(e.id, item)
+            log.debug("Item %s waits for %s %s" % ((item.action_name,) + e.key))
+            if self._hub.queue.put_into_waiting_list(e.key, item):
+                return KEEP
+
+            # nothing will wake it up, try again later
+            if self._retry(item, RetryLater("Cannot wait for %s %s" % e.key)):
+                return KEEP
+
+            self._repair(e.key)
 
         except RetryLater, e:
             log.debug("RetryLater")
             log.debug(e)
-            reactor.callLater(e.time, self._hub.queue.put, item)
+            if self._retry(item, e):
+                return KEEP
 
         except DropItem, e:
             log.debug("DropItem")
@@ -90,10 +236,78 @@ class Worker(object):
         # decide what to do based on error type
         # e.g. if we are retrying or giving up
 
-    def _call_worker(self, result, when=0):
-        self._hub.database_manager.commit()
+    def _retry(self, item, error):
+        name = item.__class__.__name__
+        self.retries[name] = self.retries.get(name, 0) + 1
+
+        if not self._hub.rest_client.offline:
+            item.attempts += 1
+
+        if item.attempts >= self.retry_attempts:
+            log.warning("Giving up %s after %s attempts" % (item.action_name,
+                                                            item.attempts))
+            self.dead_letters[name] = self.dead_letters.get(name, 0) + 1
+
+            dead_letter = db.DeadLetter()
+            dead_letter.timestamp = datetime.now()
+            dead_letter.action = unicode(name)
+            dead_letter.unique_id = self._unicode(item.unique_id)
+            dead_letter.attempts = item.attempts
+            dead_letter.error = self._unicode(error)
+            self._dms.add(dead_letter)
+            return False
+
+        # double the delay for every attempt, and pick at random
+        # between half and all of it, so that items failing together
+        # are not retried together
+        delay = min(error.time * 2 ** max(item.attempts - 1, 0),
+                    self.retry_max_delay)
+        delay = random.uniform(delay / 2.0, delay)
+        log.debug("Retrying %s in %.1f seconds" % (item.action_name, delay))
+        reactor.callLater(delay, self._hub.queue.put, item)
+        return True
+
+    def _repair(self, key):
+        # we miss the parent of an item, a cell the server knows or a
+        # directory on disk. Fetching or finding it again queues the
+        # item again too
+        log.warning("Nothing provides %s %s, repairing" % key)
+        if key[0] == 'cell':
+            self._hub.queue.put(GetUpdates(self._hub, full=True))
+        else:
+            self._hub.queue.put(RescanDirectories(self._hub))
+
+    def _unicode(self, value):
+        # filenames and messages may be utf-8 encoded strings
+        if isinstance(value, unicode):
+            return value
+        return str(value).decode('utf-8', 'replace')
+
+    def _call_worker(self, result, item):
+        self.running.pop(item, None)
+        if result is not KEEP:
+            self._hub.queue.done(item)
+
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_items:
+            self.commit()
+        else:
+            self._hub.queue.sync_journal()
+            self._hub.database_manager.savepoint()
+            if not (self._commit_call and self._commit_call.active()):
+                self._commit_call = reactor.callLater(self.commit_interval,
+                                                      self.commit)
 
         # maybe an overkill to call each item
         self._hub.desktop_tray.set_recent_updates()
 
-        reactor.callLater(0, self.work)
+        self._schedule()
+
+    def commit(self):
+        """ Commit the actions finished so far """
+        if self._commit_call and self._commit_call.active():
+            self._commit_call.cancel()
+
+        self._hub.queue.sync_journal()
+        self._hub.database_manager.commit()
+        self._uncommitted = 0